@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of the FETCH responses parsing hot path (INTERNALDATE
+# decoding included)
+#
+# ./benchmark_fetch_parser.py [--messages 1000000] [--headers-ratio 0.0]
+#                             [--min-rate MESSAGES_PER_SECOND]
+
+import argparse
+import random
+import sys
+import time
+
+import imap_folders_size
+
+months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+flags_choices = [
+    '',
+    '\\Seen',
+    '\\Seen \\Answered',
+    '\\Seen \\Flagged',
+    '$NotJunk \\Seen',
+    ]
+
+
+def synthetic_fetch_response(
+    nmessages: int,
+    headers_ratio: float = 0.0,
+    seed: int = 0,
+        ) -> list[bytes | tuple[bytes, bytes]]:
+    # Same shape as what imaplib returns for a UID FETCH FAST
+    # (or detailed FETCH when headers are requested)
+    rnd = random.Random(seed)
+    headers = (b"From: Someone <someone@example.com>\r\n"
+               b"To: me@example.com\r\n"
+               b"Subject: Synthetic message\r\n\r\n")
+    response = []
+    for seq in range(1, nmessages + 1):
+        items = (
+            f'{seq} (UID {seq * 3} RFC822.SIZE {rnd.randint(300, 30000000)} '
+            f'INTERNALDATE "{rnd.randint(1, 28):2d}-{rnd.choice(months)}-'
+            f'{rnd.randint(2000, 2024)} {rnd.randint(0, 23):02d}:'
+            f'{rnd.randint(0, 59):02d}:{rnd.randint(0, 59):02d} '
+            f'{rnd.choice(("+0000", "+0200", "-0700"))}" '
+            f'FLAGS ({rnd.choice(flags_choices)})').encode()
+        if rnd.random() < headers_ratio:
+            response.append(
+                (items + b' BODY[HEADER] {%d}' % len(headers), headers))
+            response.append(b')')
+        else:
+            response.append(items + b')')
+    return response
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmark of the FETCH responses parsing')
+    parser.add_argument('--messages', type=int, default=1000000,
+                        help='number of synthetic FETCH responses')
+    parser.add_argument('--headers-ratio', type=float, default=0.0,
+                        help='ratio of responses carrying a headers literal')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs, the best one is kept')
+    parser.add_argument('--min-rate', type=float, default=0.0,
+                        help='fail if less messages/s are parsed')
+    args = parser.parse_args()
+
+    response = synthetic_fetch_response(args.messages, args.headers_ratio)
+    nbytes = sum(
+        len(part) if isinstance(part, bytes) else len(part[0]) + len(part[1])
+        for part in response)
+    batch_size = imap_folders_size.fetch_batch_size
+    best = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        records = list(imap_folders_size.parse_fetch_responses(response))
+        # Dates are decoded by FETCH batches
+        for i in range(0, len(records), batch_size):
+            imap_folders_size.decode_internaldates(
+                [msg.date for msg in records[i:i + batch_size]])
+        elapsed = time.perf_counter() - start
+        nparsed = len(records)
+        best = elapsed if best is None else min(best, elapsed)
+    if nparsed != args.messages:
+        print(f"Parsed {nparsed} messages out of {args.messages}")
+        return 2
+    rate = args.messages / best
+    print(f"Parsed {args.messages} FETCH responses " +
+          f"({imap_folders_size.human_readable_size(nbytes)}) in " +
+          f"{best:.3f}s: {rate:,.0f} messages/s, " +
+          f"{imap_folders_size.human_readable_size(nbytes / best)}/s")
+    if rate < args.min_rate:
+        print(f"Parsing rate below {args.min_rate:,.0f} messages/s")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# End to end benchmark of the scan modes against the local fake IMAP
+# server: wall time, messages/s, bytes transferred and peak RSS of each
+# scenario, every scenario being run in its own process
+#
+# ./benchmark_scan.py [--folders 20] [--messages 5000] [--latency-ms 20]
+#                     [--scenarios sequential,async,...]
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import tabulate
+
+import fake_imap_server
+# The configuration is read from the environment at import, the scan
+# processes are started with the environment of their scenario
+import imap_folders_size as ifs
+
+# Scenario name: (kind, environment of the scan process)
+scenarios = {
+    'sequential': ('scan', {}),
+    'workers-4': ('scan', {'IMAP_WORKERS': '4'}),
+    'async': ('scan', {'IMAP_ASYNC': '1'}),
+    'async-workers-4': ('scan', {'IMAP_ASYNC': '1', 'IMAP_WORKERS': '4'}),
+    'detailed': ('scan', {'IMAP_DETAILS': '1'}),
+    'compressed': ('scan', {'IMAP_NO_COMPRESS': ''}),
+    'compressed-detailed': ('scan', {'IMAP_NO_COMPRESS': '',
+                                     'IMAP_DETAILS': '1'}),
+    'no-dates': ('scan', {'IMAP_NO_DATES': '1'}),
+    'incremental': ('incremental', {}),
+    'overview': ('overview', {'IMAP_OVERVIEW': '1'}),
+    'biggest-headers': ('biggest', {}),
+    }
+
+
+def run_scan(kind: str) -> dict:
+    user = password = 'benchmark'
+    start = time.perf_counter()
+    cnx = ifs.login(ifs.imap_server, ifs.imap_port, user, password)
+    if kind == 'overview':
+        scanned_folders = ifs.folders_overview(cnx)
+    else:
+        folders = ifs.get_folders(cnx)
+        folders_state = None
+        if ifs.folders_state_dir:
+            folders_state = ifs.load_folders_state(
+                ifs.folders_state_path(user, ifs.imap_server))
+        scanned_folders = ifs.scan_account_folders(
+            cnx, folders, user, password, None, folders_state)
+        if folders_state is not None:
+            ifs.save_folders_state(
+                ifs.folders_state_path(user, ifs.imap_server),
+                [folder_infos['state']
+                 for folder_infos, _ in scanned_folders
+                 if 'state' in folder_infos])
+    if kind == 'biggest':
+        # Headers of the biggest messages selected as the report does
+        summary = ifs.MessagesSummary()
+        biggest = ifs.BiggestMessages(ifs.biggest_count)
+        for folder_infos, _ in scanned_folders:
+            if 'summary' in folder_infos:
+                summary.merge(folder_infos['summary'])
+                biggest.merge(folder_infos['biggest'])
+        ifs.messages_subject_from_to(cnx, biggest.messages(
+            summary.quantile(ifs.biggest_percentile / 100)
+            if ifs.biggest_percentile else 0))
+    cnx.logout()
+    return {
+        'elapsed': time.perf_counter() - start,
+        'messages': sum(folder_infos.get('messages') or 0
+                        for folder_infos, _ in scanned_folders),
+        # Skipped folders are only warnings
+        'errors': sum(1 for folder_infos, ex in scanned_folders
+                      if ex and folder_infos),
+        # Kilobytes on Linux, bytes on macOS
+        'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss *
+        (1 if sys.platform == 'darwin' else 1024),
+        }
+
+
+def scan_process(
+    kind: str,
+    environment: dict[str, str],
+    port: int,
+        ) -> dict:
+    env = {
+        key: value for key, value in os.environ.items()
+        if not key.startswith('IMAP_')}
+    # COMPRESS=DEFLATE is advertised by the server, only the compressed
+    # scenarios use it
+    env['IMAP_NO_COMPRESS'] = '1'
+    env.update(environment, IMAP_SERVER='127.0.0.1', IMAP_PORT=str(port),
+               IMAP_NO_SSL='1', NO_PROGRESS='1')
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--scan', kind],
+        env=env, capture_output=True, text=True)
+    if process.returncode:
+        raise Exception(f"{kind} scan failed: {process.stderr.strip()}")
+    return json.loads(process.stdout.splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the scan modes against a fake IMAP server')
+    parser.add_argument('--folders', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=5000,
+                        help='messages per folder')
+    parser.add_argument('--size-mu', type=float, default=9.0,
+                        help='log-normal messages size distribution mu')
+    parser.add_argument('--size-sigma', type=float, default=1.5,
+                        help='log-normal messages size distribution sigma')
+    parser.add_argument('--latency-ms', type=float, default=20.0,
+                        help='round trip time injected per command')
+    parser.add_argument('--changes', type=float, default=0.01,
+                        help='ratio of new and changed messages between '
+                        'the two runs of the incremental scenario')
+    parser.add_argument('--scenarios', default=','.join(scenarios),
+                        help='comma separated list of scenarios')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--scan', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scan:
+        print(json.dumps(run_scan(args.scan)))
+        return 0
+
+    account = fake_imap_server.SyntheticAccount(
+        args.folders, args.messages, args.size_mu, args.size_sigma)
+    server = fake_imap_server.FakeImapServer(
+        account, latency=args.latency_ms / 1000,
+        extensions=('CONDSTORE', 'LIST-STATUS', 'STATUS=SIZE',
+                    'COMPRESS=DEFLATE')).start()
+    port = server.server_address[1]
+    print(f"{account.messages()} messages in {args.folders} folders, "
+          f"{args.latency_ms:g}ms latency")
+    results = []
+    for name in args.scenarios.split(','):
+        kind, environment = scenarios[name]
+        with tempfile.TemporaryDirectory() as state_dir:
+            if kind == 'incremental':
+                # First full scan filling the state, then a rescan after
+                # some mailbox activity
+                environment = dict(environment, IMAP_STATE_DIR=state_dir)
+                scan_process('scan', environment, port)
+                account.mutate(args.changes, args.changes)
+                kind = 'scan'
+            server.reset_counters()
+            result = scan_process(kind, environment, port)
+        counters = server.reset_counters()
+        results.append(dict(result, scenario=name, **counters))
+    server.shutdown()
+
+    print(tabulate.tabulate([
+        [result['scenario'],
+         f"{result['elapsed']:.2f}s",
+         result['messages'],
+         f"{result['messages'] / result['elapsed']:,.0f}",
+         result['commands'],
+         ifs.human_readable_size(result['bytes_out']),
+         ifs.human_readable_size(result['bytes_in']),
+         ifs.human_readable_size(result['maxrss']),
+         result['errors']]
+        for result in results],
+        headers=['Scenario', 'Wall time', '# Msg', 'Msg/s', 'Commands',
+                 'Received', 'Sent', 'Peak RSS', 'Errors']))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,646 @@
+#!/usr/bin/env python3
+
+# Local IMAP stand-in server serving a synthetic account, for measuring
+# the scan modes without a real mailbox (plain TCP, any login accepted)
+#
+# ./fake_imap_server.py [--port 1143] [--folders 20] [--messages 1000]
+#                       [--latency-ms 0] [--drop-bytes 0] [--gmail]
+#                       [--compress]
+# IMAP_SERVER=localhost IMAP_PORT=1143 IMAP_NO_SSL=1 LOGPASSWD=x \
+#     ./imap_folders_size.py
+
+import argparse
+from array import array
+import bisect
+import queue
+import random
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+import zlib
+
+months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+# Flags combinations given to the synthetic messages and their weights
+flags_choices = [
+    '\\Seen',
+    '',
+    '\\Seen \\Answered',
+    '\\Seen \\Flagged',
+    '$Junk',
+    ]
+flags_weights = [75, 15, 6, 3, 1]
+fetch_macros = {
+    'ALL': 'FLAGS INTERNALDATE RFC822.SIZE ENVELOPE',
+    'FAST': 'FLAGS INTERNALDATE RFC822.SIZE',
+    'FULL': 'FLAGS INTERNALDATE RFC822.SIZE ENVELOPE BODY',
+    }
+header_fields_re = re.compile(
+    r'BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]|BODY(?:\.PEEK)?\[HEADER\]'
+    r'|RFC822\.HEADER')
+changedsince_re = re.compile(r'\s*\(CHANGEDSINCE (\d+)\)\s*$', re.I)
+
+
+class SyntheticFolder:
+    # Messages attributes are kept in compact arrays, the headers are
+    # generated on demand from the UID
+    def __init__(
+        self,
+        name: str,
+        rnd: random.Random,
+        flags: tuple[str, ...] = (),
+            ):
+        self.name = name
+        self.flags = flags
+        self.uidvalidity = rnd.randint(1, (1 << 31) - 1)
+        self.uidnext = 1
+        self.highestmodseq = 1
+        self.uids = array('L')
+        self.sizes = array('q')
+        self.dates = array('q')
+        self.flag_choices = array('B')
+        self.modseqs = array('Q')
+        # Gmail accounts only: X-GM-MSGID and X-GM-LABELS
+        self.msgids = array('Q')
+        self.labels = []
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def append(
+        self,
+        size: int,
+        date: int,
+        flag_choice: int,
+        msgid: int = 0,
+        labels: tuple[str, ...] = (),
+            ) -> None:
+        self.highestmodseq += 1
+        self.uids.append(self.uidnext)
+        self.uidnext += 1
+        self.sizes.append(size)
+        self.dates.append(date)
+        self.flag_choices.append(flag_choice)
+        self.modseqs.append(self.highestmodseq)
+        self.msgids.append(msgid)
+        self.labels.append(labels)
+
+    def set_flags(self, index: int, flag_choice: int) -> None:
+        self.highestmodseq += 1
+        self.flag_choices[index] = flag_choice
+        self.modseqs[index] = self.highestmodseq
+
+    def expunge(self, index: int) -> None:
+        for column in (self.uids, self.sizes, self.dates, self.flag_choices,
+                       self.modseqs, self.msgids, self.labels):
+            del column[index]
+
+    def unseen(self) -> int:
+        return sum(1 for choice in self.flag_choices
+                   if '\\Seen' not in flags_choices[choice])
+
+    def size(self) -> int:
+        return sum(self.sizes)
+
+    def headers(self, index: int) -> dict[str, str]:
+        uid = self.uids[index]
+        sender = uid % 97
+        return {
+            'FROM': f'Sender {sender} <sender{sender}@domain{sender % 13}.com>',
+            'TO': 'Me <me@example.com>',
+            'SUBJECT': f'Synthetic message {uid} of {self.name}',
+            'MESSAGE-ID': f'<{uid}.{self.uidvalidity}@fake.example.com>',
+            'DATE': time.strftime('%a, %d %b %Y %H:%M:%S +0000',
+                                  time.gmtime(self.dates[index])),
+            }
+
+    def indexes(self, sequence_set: str, by_uid: bool) -> list[int]:
+        # Messages indexes matching a sequence set, the UIDs being
+        # sorted ranges are found by bisection
+        if not self.uids:
+            return []
+        last = self.uids[-1] if by_uid else len(self.uids)
+        indexes = set()
+        for part in sequence_set.split(','):
+            first, _, end = part.partition(':')
+            first = last if first == '*' else int(first)
+            end = first if not end else last if end == '*' else int(end)
+            if first > end:
+                first, end = end, first
+            if by_uid:
+                indexes.update(range(
+                    bisect.bisect_left(self.uids, first),
+                    bisect.bisect_right(self.uids, end)))
+            else:
+                indexes.update(range(max(first, 1) - 1, min(end, last)))
+        return sorted(indexes)
+
+
+# Gmail special-use folders: (name, flags, label of their messages)
+gmail_folders = [
+    ('[Gmail]/All Mail', ('\\All',), None),
+    ('[Gmail]/Sent Mail', ('\\Sent',), '\\Sent'),
+    ('[Gmail]/Important', ('\\Important',), '\\Important'),
+    ('[Gmail]/Trash', ('\\Trash',), None),
+    ('[Gmail]/Spam', ('\\Junk',), None),
+    ]
+
+
+class SyntheticAccount:
+    # Folders with a log-normal messages size distribution (median
+    # around exp(size_mu) bytes) and dates spread over the last years.
+    # A Gmail account has folders * messages / 2 messages in All Mail,
+    # each one with 0 to 3 labels and listed in its labels folders, plus
+    # messages / 10 messages in each of Trash and Spam
+    def __init__(
+        self,
+        folders: int = 20,
+        messages: int = 1000,
+        size_mu: float = 9.0,
+        size_sigma: float = 1.5,
+        years: int = 10,
+        seed: int = 0,
+        gmail: bool = False,
+            ):
+        self.rnd = random.Random(seed)
+        self.size_mu = size_mu
+        self.size_sigma = size_sigma
+        self.dates_end = int(time.time())
+        self.dates_start = self.dates_end - years * 365 * 86400
+        self.msgids = 0
+        names = ['INBOX'] + [f'Folder {n:03d}' for n in range(1, folders)]
+        # A few names needing quoting or modified UTF-7 decoding
+        if folders > 3:
+            names[-2:] = ['Archives/Caf&AOk-', 'Quoted "name"']
+        self.folders = {'[Gmail]': SyntheticFolder(
+            '[Gmail]', self.rnd, ('\\Noselect', '\\HasChildren'))}
+        if gmail:
+            self.gmail_folders(names, folders * messages // 2, messages // 10)
+            return
+        for name in names:
+            folder = SyntheticFolder(name, self.rnd)
+            for _ in range(messages):
+                self.append_message(folder)
+            self.folders[name] = folder
+
+    def gmail_folders(
+        self,
+        names: list[str],
+        messages: int,
+        deleted: int,
+            ) -> None:
+        labels_folders = {'\\Inbox': SyntheticFolder('INBOX', self.rnd)}
+        labels_folders.update(
+            (name, SyntheticFolder(name, self.rnd)) for name in names[1:])
+        for name, flags, label in gmail_folders:
+            self.folders[name] = SyntheticFolder(
+                name, self.rnd, ('\\HasNoChildren',) + flags)
+            if label:
+                labels_folders[label] = self.folders[name]
+        self.folders.update(
+            (folder.name, folder) for folder in labels_folders.values())
+        all_mail = self.folders['[Gmail]/All Mail']
+        labels_names = list(labels_folders)
+        for _ in range(messages):
+            labels = tuple(self.rnd.sample(
+                labels_names, self.rnd.choice((0, 1, 1, 2, 2, 3))))
+            self.append_message(all_mail, labels)
+            for label in labels:
+                labels_folders[label].append(
+                    all_mail.sizes[-1], all_mail.dates[-1],
+                    all_mail.flag_choices[-1], all_mail.msgids[-1], labels)
+        for name in ('[Gmail]/Trash', '[Gmail]/Spam'):
+            for _ in range(deleted):
+                self.append_message(self.folders[name])
+
+    def append_message(
+        self,
+        folder: SyntheticFolder,
+        labels: tuple[str, ...] = (),
+            ) -> None:
+        self.msgids += 1
+        folder.append(
+            int(self.rnd.lognormvariate(self.size_mu, self.size_sigma)) + 300,
+            self.rnd.randint(self.dates_start, self.dates_end),
+            self.rnd.choices(range(len(flags_choices)), flags_weights)[0],
+            (1 << 60) + self.msgids, labels)
+
+    def mutate(
+        self,
+        new_ratio: float = 0.01,
+        flags_ratio: float = 0.01,
+        expunge_ratio: float = 0.0,
+            ) -> None:
+        # Activity between two scans: new messages, flags changes and
+        # expunged messages in every selectable folder
+        for folder in self.selectable_folders():
+            count = len(folder)
+            for index in sorted(self.rnd.sample(
+                    range(count), int(count * expunge_ratio)), reverse=True):
+                folder.expunge(index)
+            for index in self.rnd.sample(range(len(folder)),
+                                         int(len(folder) * flags_ratio)):
+                folder.set_flags(index, self.rnd.randrange(len(flags_choices)))
+            for _ in range(int(count * new_ratio)):
+                self.append_message(folder)
+
+    def selectable_folders(self) -> list[SyntheticFolder]:
+        return [folder for folder in self.folders.values()
+                if '\\Noselect' not in folder.flags]
+
+    def messages(self) -> int:
+        return sum(len(folder) for folder in self.folders.values())
+
+
+def quote(name: str) -> str:
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def parse_astring(args: str) -> tuple[str, str]:
+    # First (possibly quoted) argument and the remaining of the command
+    if not args.startswith('"'):
+        value, _, args = args.partition(' ')
+        return value, args
+    value = []
+    index = 1
+    while args[index] != '"':
+        if args[index] == '\\':
+            index += 1
+        value.append(args[index])
+        index += 1
+    return ''.join(value), args[index + 1:].lstrip()
+
+
+def internaldate(epoch: int) -> str:
+    tm = time.gmtime(epoch)
+    return (f'{tm.tm_mday:2d}-{months[tm.tm_mon - 1]}-{tm.tm_year} '
+            f'{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d} +0000')
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    wbufsize = 1 << 16
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        # Commands are timestamped by a reader thread as soon as they
+        # arrive and processed once the injected latency has elapsed, so
+        # pipelined commands only pay the round trip once
+        commands = queue.SimpleQueue()
+        threading.Thread(
+            target=self.read_commands, args=(commands,), daemon=True).start()
+        self.selected = None
+        self.sent = 0
+        # COMPRESS=DEFLATE streams once negotiated
+        self.compressor = None
+        self.decompressor = None
+        self.send(b'* OK [CAPABILITY ' + self.server.capabilities() +
+                  b'] Fake IMAP server ready\r\n')
+        self.flush()
+        while True:
+            arrival, line = commands.get()
+            if line is None:
+                return
+            delay = arrival + self.server.latency - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                running = self.command(line.decode('utf-8', 'replace'))
+                self.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            if not running:
+                return
+
+    def read_commands(self, commands: queue.SimpleQueue) -> None:
+        # Lines split from the raw reads, inflated once compression is
+        # negotiated (the client waits for the COMPRESS completion before
+        # sending compressed data)
+        pending = b''
+        try:
+            while data := self.rfile.read1(1 << 16):
+                self.server.count('bytes_in', len(data))
+                if self.decompressor:
+                    data = self.decompressor.decompress(data)
+                *lines, pending = (pending + data).split(b'\n')
+                for line in lines:
+                    commands.put((time.monotonic(), line.rstrip(b'\r')))
+        except (OSError, ValueError, zlib.error):
+            pass
+        commands.put((0, None))
+
+    def send(self, data: bytes) -> None:
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self.server.count('bytes_out', len(data))
+        self.wfile.write(data)
+        self.sent += len(data)
+        if self.server.drop_bytes and self.sent >= self.server.drop_bytes:
+            # Connection dropped in the middle of a response, the reader
+            # thread being woken up
+            self.flush()
+            self.request.shutdown(socket.SHUT_RDWR)
+            raise ConnectionResetError('Fake IMAP server dropped connection')
+
+    def flush(self) -> None:
+        if self.compressor:
+            data = self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.server.count('bytes_out', len(data))
+            self.wfile.write(data)
+            self.sent += len(data)
+        self.wfile.flush()
+
+    def send_line(self, line: str) -> None:
+        self.send(line.encode() + b'\r\n')
+
+    def command(self, line: str) -> bool:
+        tag, _, line = line.partition(' ')
+        name, _, args = line.partition(' ')
+        name = name.upper()
+        by_uid = name == 'UID'
+        if by_uid:
+            name, _, args = args.partition(' ')
+            name = name.upper()
+        self.server.count('commands', 1)
+        handler = getattr(self, f'cmd_{name}', None)
+        if handler is None:
+            self.send_line(f'{tag} BAD Unknown command {name}')
+            return True
+        try:
+            error = handler(args, by_uid)
+        except (ValueError, IndexError, KeyError) as e:
+            error = f'BAD {name} error: {e!r}'
+        if name == 'LOGOUT':
+            self.send_line(f'{tag} OK LOGOUT completed')
+            return False
+        if error:
+            self.send_line(f'{tag} {error}')
+        elif name in ('SELECT', 'EXAMINE'):
+            self.send_line(f'{tag} OK [READ-ONLY] {name} completed')
+        elif name == 'LOGIN':
+            # Authenticated capabilities, as most servers send them
+            self.send(f'{tag} OK [CAPABILITY '.encode() +
+                      self.server.capabilities() + b'] LOGIN completed\r\n')
+        else:
+            self.send_line(f'{tag} OK {name} completed')
+            if name == 'COMPRESS':
+                # Right after the (uncompressed) completion
+                self.compressor = zlib.compressobj(
+                    zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return True
+
+    def cmd_CAPABILITY(self, args: str, by_uid: bool) -> str | None:
+        self.send(b'* CAPABILITY ' + self.server.capabilities() + b'\r\n')
+
+    def cmd_LOGIN(self, args: str, by_uid: bool) -> str | None:
+        return None
+
+    def cmd_LOGOUT(self, args: str, by_uid: bool) -> str | None:
+        self.send_line('* BYE Fake IMAP server logging out')
+
+    def cmd_NOOP(self, args: str, by_uid: bool) -> str | None:
+        return None
+
+    def cmd_COMPRESS(self, args: str, by_uid: bool) -> str | None:
+        if 'COMPRESS=DEFLATE' not in self.server.extensions or \
+                args.upper() != 'DEFLATE':
+            return f'BAD COMPRESS {args} not supported'
+        if self.compressor:
+            return 'NO [COMPRESSIONACTIVE] Already compressed'
+        return None
+
+    def cmd_ENABLE(self, args: str, by_uid: bool) -> str | None:
+        enabled = [extension for extension in args.upper().split()
+                   if extension in self.server.extensions]
+        self.send_line('* ENABLED ' + ' '.join(enabled))
+
+    def cmd_GETQUOTAROOT(self, args: str, by_uid: bool) -> str | None:
+        used = sum(folder.size()
+                   for folder in self.server.account.folders.values())
+        self.send_line(f'* QUOTAROOT {quote(parse_astring(args)[0])} ""')
+        self.send_line(f'* QUOTA "" (STORAGE {used // 1024} '
+                       f'{max(used // 256, 1024)})')
+
+    def status_line(self, folder: SyntheticFolder, items: list[str]) -> str:
+        values = {
+            'MESSAGES': lambda: len(folder),
+            'UNSEEN': folder.unseen,
+            'SIZE': folder.size,
+            'UIDNEXT': lambda: folder.uidnext,
+            'UIDVALIDITY': lambda: folder.uidvalidity,
+            'HIGHESTMODSEQ': lambda: folder.highestmodseq,
+            'RECENT': lambda: 0,
+            }
+        return (f'* STATUS {quote(folder.name)} (' +
+                ' '.join(f'{item} {values[item]()}' for item in items) + ')')
+
+    def cmd_LIST(self, args: str, by_uid: bool) -> str | None:
+        status_items = None
+        match = re.search(r'RETURN \(STATUS \(([^)]*)\)\)', args, re.I)
+        if match:
+            if 'LIST-STATUS' not in self.server.extensions:
+                return 'BAD LIST-STATUS not supported'
+            status_items = match.group(1).upper().split()
+        for folder in self.server.account.folders.values():
+            flags = folder.flags or ('\\HasNoChildren',)
+            self.send_line(
+                f'* LIST ({" ".join(flags)}) "/" {quote(folder.name)}')
+            if status_items and '\\Noselect' not in folder.flags:
+                self.send_line(self.status_line(folder, status_items))
+
+    def folder(self, args: str) -> tuple[SyntheticFolder | None, str]:
+        name, args = parse_astring(args)
+        folder = self.server.account.folders.get(name)
+        if folder is None or '\\Noselect' in folder.flags:
+            return None, args
+        return folder, args
+
+    def cmd_STATUS(self, args: str, by_uid: bool) -> str | None:
+        folder, args = self.folder(args)
+        if folder is None:
+            return 'NO Mailbox does not exist'
+        self.send_line(self.status_line(
+            folder, args.strip('() ').upper().split()))
+
+    def cmd_EXAMINE(self, args: str, by_uid: bool) -> str | None:
+        self.selected, _ = self.folder(args)
+        folder = self.selected
+        if folder is None:
+            return 'NO Mailbox does not exist'
+        self.send_line('* FLAGS (\\Answered \\Flagged \\Deleted \\Seen '
+                       '\\Draft $Junk)')
+        self.send_line(f'* {len(folder)} EXISTS')
+        self.send_line('* 0 RECENT')
+        self.send_line(f'* OK [UIDVALIDITY {folder.uidvalidity}] UIDs valid')
+        self.send_line(f'* OK [UIDNEXT {folder.uidnext}] Predicted next UID')
+        if 'CONDSTORE' in self.server.extensions:
+            self.send_line(f'* OK [HIGHESTMODSEQ {folder.highestmodseq}] '
+                           'Highest')
+
+    cmd_SELECT = cmd_EXAMINE
+
+    def cmd_SEARCH(self, args: str, by_uid: bool) -> str | None:
+        # Only the ALL and UID <sequence set> criteria are supported
+        folder = self.selected
+        if folder is None:
+            return 'BAD No mailbox selected'
+        criteria = args.split()
+        if criteria and criteria[0].upper() == 'UID':
+            indexes = folder.indexes(criteria[1], True)
+        else:
+            indexes = range(len(folder))
+        if by_uid:
+            found = (str(folder.uids[index]) for index in indexes)
+        else:
+            found = (str(index + 1) for index in indexes)
+        self.send_line(' '.join(('* SEARCH', *found)))
+
+    def cmd_FETCH(self, args: str, by_uid: bool) -> str | None:
+        folder = self.selected
+        if folder is None:
+            return 'BAD No mailbox selected'
+        sequence_set, _, items = args.partition(' ')
+        changedsince = 0
+        match = changedsince_re.search(items)
+        if match:
+            changedsince = int(match.group(1))
+            items = items[:match.start()]
+        items = items.strip('() ').upper()
+        items = fetch_macros.get(items, items)
+        with_uid = by_uid or re.search(r'\bUID\b', items)
+        with_size = 'RFC822.SIZE' in items
+        with_date = 'INTERNALDATE' in items
+        with_flags = re.search(r'\bFLAGS\b', items)
+        with_modseq = 'MODSEQ' in items or changedsince
+        gmail = 'X-GM-EXT-1' in self.server.extensions
+        with_msgid = gmail and 'X-GM-MSGID' in items
+        with_labels = gmail and 'X-GM-LABELS' in items
+        headers = header_fields_re.search(items)
+        fields = None
+        if headers and headers.group(1):
+            fields = headers.group(1).split()
+        for index in folder.indexes(sequence_set, by_uid):
+            if folder.modseqs[index] <= changedsince:
+                continue
+            attributes = []
+            if with_uid:
+                attributes.append(f'UID {folder.uids[index]}')
+            if with_size:
+                attributes.append(f'RFC822.SIZE {folder.sizes[index]}')
+            if with_date:
+                attributes.append(
+                    f'INTERNALDATE "{internaldate(folder.dates[index])}"')
+            if with_flags:
+                attributes.append(
+                    f'FLAGS ({flags_choices[folder.flag_choices[index]]})')
+            if with_modseq:
+                attributes.append(f'MODSEQ ({folder.modseqs[index]})')
+            if with_msgid:
+                attributes.append(f'X-GM-MSGID {folder.msgids[index]}')
+            if with_labels:
+                attributes.append('X-GM-LABELS (' + ' '.join(
+                    map(quote, folder.labels[index])) + ')')
+            response = f'* {index + 1} FETCH (' + ' '.join(attributes)
+            if headers:
+                message_headers = folder.headers(index)
+                literal = ''.join(
+                    f'{field.title()}: {message_headers[field]}\r\n'
+                    for field in (fields or message_headers)
+                    if field in message_headers).encode() + b'\r\n'
+                item = headers.group(0).replace('.PEEK', '')
+                self.send(f'{response} {item} {{{len(literal)}}}\r\n'.encode()
+                          + literal + b')\r\n')
+            else:
+                self.send_line(response + ')')
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    base_capabilities = ('IMAP4rev1', 'LITERAL+', 'QUOTA', 'ENABLE')
+
+    def __init__(
+        self,
+        account: SyntheticAccount,
+        port: int = 0,
+        latency: float = 0.0,
+        extensions: tuple[str, ...] = ('CONDSTORE', 'LIST-STATUS',
+                                       'STATUS=SIZE'),
+        drop_bytes: int = 0,
+            ):
+        super().__init__(('127.0.0.1', port), FakeImapHandler)
+        self.account = account
+        self.latency = latency
+        self.extensions = set(extensions)
+        # Connections dropped once they sent that many bytes (0: never)
+        self.drop_bytes = drop_bytes
+        self.counters_lock = threading.Lock()
+        self.counters = {'bytes_in': 0, 'bytes_out': 0, 'commands': 0}
+
+    def capabilities(self) -> bytes:
+        return ' '.join(
+            self.base_capabilities + tuple(sorted(self.extensions))).encode()
+
+    def count(self, counter: str, value: int) -> None:
+        with self.counters_lock:
+            self.counters[counter] += value
+
+    def reset_counters(self) -> dict[str, int]:
+        with self.counters_lock:
+            counters = self.counters
+            self.counters = dict.fromkeys(counters, 0)
+        return counters
+
+    def start(self) -> 'FakeImapServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Fake IMAP server serving a synthetic account')
+    parser.add_argument('--port', type=int, default=1143)
+    parser.add_argument('--folders', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='messages per folder')
+    parser.add_argument('--size-mu', type=float, default=9.0,
+                        help='log-normal messages size distribution mu')
+    parser.add_argument('--size-sigma', type=float, default=1.5,
+                        help='log-normal messages size distribution sigma')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='round trip time injected per command')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--drop-bytes', type=int, default=0,
+                        help='drop each connection after sending that many '
+                        'bytes, for testing reconnections')
+    parser.add_argument('--gmail', action='store_true',
+                        help='Gmail account: labels folders, All Mail and '
+                        'the X-GM-EXT-1 extension')
+    parser.add_argument('--compress', action='store_true',
+                        help='COMPRESS=DEFLATE extension')
+    args = parser.parse_args()
+
+    account = SyntheticAccount(args.folders, args.messages, args.size_mu,
+                               args.size_sigma, seed=args.seed,
+                               gmail=args.gmail)
+    extensions = ('CONDSTORE', 'LIST-STATUS', 'STATUS=SIZE')
+    if args.gmail:
+        extensions += ('X-GM-EXT-1',)
+    if args.compress:
+        extensions += ('COMPRESS=DEFLATE',)
+    server = FakeImapServer(account, args.port, args.latency_ms / 1000,
+                            extensions, args.drop_bytes)
+    print(f"Serving {account.messages()} messages in {args.folders} folders "
+          f"on 127.0.0.1:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
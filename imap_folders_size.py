@@ -3,20 +3,67 @@
 # LOGNAME=my-email
 # LOGPASSWD=xxxxx
 # IMAP_SERVER=yyyy (default to imap.gmail.com)
+# IMAP_PORT=n (default to 993)
+# IMAP_NO_SSL=1 (plain connection, for local test servers only)
+# IMAP_WORKERS=n (number of parallel IMAP connections, default to 1)
+# IMAP_STATE_DIR=zzzz (directory keeping folders state for incremental scans)
+# IMAP_FETCH_BATCH=n (number of messages retrieved per FETCH, default to 5000)
+# IMAP_ASYNC=1 (scan folders with the pipelining asyncio engine)
+# IMAP_PIPELINE_DEPTH=n (folders in flight per asyncio connection, default to 4)
+# IMAP_OVERVIEW=1 (folders table only, from LIST-STATUS/STATUS without FETCH)
+# IMAP_INDEX=file (SQLite index of folders and messages updated by each scan)
+# IMAP_INDEX_REPORT=report (largest[:n], growth[:days] or old-unread[:days]
+#                           from IMAP_INDEX, without connecting to IMAP)
+# IMAP_RESUME=messages-xxx.csv (resume an interrupted messages CSV export)
+# IMAP_BIGGEST_COUNT=n (at most n biggest messages reported, default to 1000)
+# IMAP_BIGGEST_PERCENTILE=p (biggest messages over the p-th size percentile,
+#                            default to 95, 0 for the n biggest ones only)
+# IMAP_ACCOUNTS=file (batch scan of the login|password|server accounts)
+# IMAP_BATCH_PROCESSES=n (accounts scanned concurrently, default to 4)
+# IMAP_SERVER_CONNECTIONS=n (batch IMAP connections per server, default to 8)
+# IMAP_STATS=1|file.json|file.prom (IMAP commands time and bytes summary,
+#                                   also written as JSON or Prometheus file)
+# IMAP_TIMEOUT=s (dropped connection detection, default to 300 seconds)
+# IMAP_RECONNECT=n (reconnections attempts per command, default to 3)
+# IMAP_KEEPALIVE=s (NOOP interval while the connection is idle, default to 60)
+# IMAP_GROUP_BY=domain;folder,year (group-by reports separated by ';' over
+#                                   sender, domain, folder, year, month, age)
+# IMAP_GROUP_BY_ROWS=n (biggest groups printed per report, default to 20)
+# IMAP_LOCAL=path (offline scan of an mbox file, a Maildir or a directory
+#                  of those instead of the IMAP account)
+# IMAP_GMAIL=1 (scan Gmail All Mail, Trash and Spam only, labels usage being
+#               derived from X-GM-LABELS)
+# IMAP_NO_COMPRESS=1 (no COMPRESS=DEFLATE even if the server supports it)
+# IMAP_NO_DATES=1 (FETCH RFC822.SIZE and FLAGS only, without dates reports)
 
+import asyncio
+import collections
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait)
 import contextlib
 import csv
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import email
 import getpass
+import heapq
 import imapclient
 import imaplib
+import io
+import json
+import mmap
 import numpy as np
 import os
+import queue
 import re
 from rich.progress import Progress
+import sqlite3
+import ssl
 import sys
 import tabulate
+import threading
+import time
+from typing import Callable, Iterator, NamedTuple
+import zlib
 
 
 class FolderProgress:
@@ -30,20 +77,869 @@ class FolderProgress:
         self.task = task
 
     def update_task(self, **kwargs):
-        self.progress.update(self.task, refresh=True, **kwargs)
+        with imap_stats.timed('progress'):
+            self.progress.update(self.task, refresh=True, **kwargs)
+
+
+class ImapStats:
+    # Time and bytes of each IMAP command name, and time of the local
+    # processing phases (FETCH parsing, headers decoding, progress bars)
+    # per folder. Shared by the scan threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Command: [count, seconds, max seconds, bytes in, bytes out]
+        self.commands = {}
+        # (phase, folder): seconds
+        self.phases = {}
+        # COMPRESS=DEFLATE connections: [bytes in, wire bytes in, bytes
+        # out, wire bytes out]
+        self.compression = [0, 0, 0, 0]
+        # Messages returned by FETCH (the incremental scans only fetch
+        # the new and changed ones)
+        self.fetched_messages = 0
+
+    def record_command(
+        self,
+        command: str,
+        elapsed: float,
+        bytes_in: int,
+        bytes_out: int,
+            ) -> None:
+        with self.lock:
+            stats = self.commands.setdefault(command, [0, 0.0, 0.0, 0, 0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            stats[3] += bytes_in
+            stats[4] += bytes_out
+
+    def record_compression(
+        self,
+        bytes_in: int,
+        wire_bytes_in: int,
+        bytes_out: int,
+        wire_bytes_out: int,
+            ) -> None:
+        with self.lock:
+            for index, count in enumerate(
+                    (bytes_in, wire_bytes_in, bytes_out, wire_bytes_out)):
+                self.compression[index] += count
+
+    def record_fetched(self, messages: int) -> None:
+        with self.lock:
+            self.fetched_messages += messages
+
+    def savings_rows(self) -> list[list[str]]:
+        # Bytes not transferred thanks to the compression and to the
+        # INTERNALDATE items not fetched (uncompressed size estimate)
+        rows = []
+        bytes_in, wire_bytes_in, bytes_out, wire_bytes_out = \
+            self.compression
+        if bytes_in or bytes_out:
+            rows += [
+                [f"COMPRESS=DEFLATE {direction}", human_readable_size(size),
+                 human_readable_size(wire_size),
+                 human_readable_size(size - wire_size),
+                 f"{100 * (size - wire_size) / (size or 1):.1f}%"]
+                for direction, size, wire_size in (
+                    ('received', bytes_in, wire_bytes_in),
+                    ('sent', bytes_out, wire_bytes_out))]
+        if not fetch_dates and self.fetched_messages:
+            saved = self.fetched_messages * internaldate_item_size
+            rows.append([
+                "No INTERNALDATE", f"{self.fetched_messages} messages", '',
+                human_readable_size(saved), ''])
+        return rows
+
+    @contextlib.contextmanager
+    def timed(self, phase: str, mbx: str = '') -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[(phase, mbx)] = \
+                    self.phases.get((phase, mbx), 0.0) + elapsed
+
+    def commands_rows(self) -> list[list[str | int | float]]:
+        return [
+            [command, count, seconds, 1000 * seconds / count,
+             1000 * max_seconds, human_readable_size(bytes_in),
+             human_readable_size(bytes_out)]
+            for command, (count, seconds, max_seconds, bytes_in, bytes_out)
+            in sorted(self.commands.items(), key=lambda item: -item[1][1])]
+
+    def phases_rows(self) -> list[list[str | float]]:
+        # Total time of each phase and its slowest folder
+        rows = {}
+        for (phase, mbx), seconds in self.phases.items():
+            row = rows.setdefault(phase, [phase, 0.0, '', 0.0])
+            row[1] += seconds
+            if mbx and seconds > row[3]:
+                row[2:] = [mailbox_real_name(mbx), seconds]
+        return sorted(rows.values(), key=lambda row: -row[1])
+
+    def to_json(self) -> dict:
+        return {
+            'commands': {
+                command: dict(zip(
+                    ('count', 'seconds', 'max_seconds', 'bytes_in',
+                     'bytes_out'), stats))
+                for command, stats in self.commands.items()},
+            'phases': [
+                {'phase': phase, 'folder': mailbox_real_name(mbx),
+                 'seconds': seconds}
+                for (phase, mbx), seconds in self.phases.items()],
+            'compression': dict(zip(
+                ('bytes_in', 'wire_bytes_in', 'bytes_out', 'wire_bytes_out'),
+                self.compression)),
+            'fetched_messages': self.fetched_messages,
+            }
+
+    def to_prometheus(self, labels: dict[str, str]) -> str:
+        # Text exposition format, for the node exporter textfile collector
+        def metric_labels(**extra_labels: str) -> str:
+            return '{' + ','.join(
+                '%s="%s"' % (name, value.replace('\\', '\\\\').replace(
+                    '"', '\\"').replace('\n', '\\n'))
+                for name, value in dict(labels, **extra_labels).items()) + '}'
+
+        lines = []
+        for index, (name, kind, description) in enumerate((
+                ('imap_commands_total', 'counter', 'IMAP commands sent'),
+                ('imap_command_seconds_total', 'counter',
+                 'Time waiting for IMAP commands completion'),
+                ('imap_command_max_seconds', 'gauge',
+                 'Slowest IMAP command completion'),
+                ('imap_command_received_bytes_total', 'counter',
+                 'Bytes received for IMAP commands'),
+                ('imap_command_sent_bytes_total', 'counter',
+                 'Bytes sent for IMAP commands'))):
+            lines += [f"# HELP {name} {description}",
+                      f"# TYPE {name} {kind}"]
+            lines += [
+                f"{name}{metric_labels(command=command)} {stats[index]}"
+                for command, stats in sorted(self.commands.items())]
+        lines += ["# HELP imap_phase_seconds_total Local processing time "
+                  "per folder",
+                  "# TYPE imap_phase_seconds_total counter"]
+        lines += [
+            "imap_phase_seconds_total" +
+            f"{metric_labels(phase=phase, folder=mailbox_real_name(mbx))} " +
+            f"{seconds}"
+            for (phase, mbx), seconds in sorted(self.phases.items())]
+        lines += ["# HELP imap_compressed_bytes_total Bytes of the "
+                  "COMPRESS=DEFLATE connections, before and after compression",
+                  "# TYPE imap_compressed_bytes_total counter"]
+        lines += [
+            "imap_compressed_bytes_total" +
+            f"{metric_labels(direction=direction, stream=stream)} {count}"
+            for (direction, stream), count in zip(
+                (('in', 'imap'), ('in', 'wire'),
+                 ('out', 'imap'), ('out', 'wire')), self.compression)]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str, labels: dict[str, str]) -> None:
+        # Atomic replacement, the file being possibly collected meanwhile
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            if path.endswith('.prom'):
+                f.write(self.to_prometheus(labels))
+            else:
+                json.dump(dict(self.to_json(), **labels), f, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+
+class MessagesStore:
+    # Columnar messages metadata: one NumPy array per attribute, the
+    # folder is an index in the folders list, the sender an index in the
+    # senders list (dictionary encoded From addresses, '' when unknown)
+    # and the flags a bit mask whose bits are given by the flag_names list
+    columns = ['id', 'size', 'date', 'flags', 'folder']
+    system_flags = (
+        '\\Seen',
+        '\\Answered',
+        '\\Flagged',
+        '\\Deleted',
+        '\\Draft',
+        '\\Recent',
+        )
+    dtypes = {
+        'ids': np.uint32,                # IMAP UIDs are 32 bits
+        'sizes': np.int64,
+        'dates': 'datetime64[s]',        # UTC, NaT when unknown
+        'tzoffsets': np.int16,           # minutes east of UTC
+        'folder_ids': np.uint32,
+        'sender_ids': np.uint32,
+        'flags': np.uint64,
+        # End offset of the message raw headers in headers_data
+        'header_ends': np.int64,
+        }
+
+    def __init__(self):
+        self.folders = []
+        self.senders = ['']
+        self._senders_ids = {'': 0}
+        self.flag_names = list(self.system_flags)
+        self._flags_masks = {}
+        self._chunks = {column: [] for column in self.dtypes}
+        self._columns = {
+            column: np.empty(0, dtype)
+            for column, dtype in self.dtypes.items()}
+        # Raw From/To/Subject/Message-ID headers (IMAP_DETAILS) back to
+        # back, only decoded for the reported messages
+        self.headers_data = bytearray()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _column(self, column: str) -> np.ndarray:
+        # Appended chunks are only concatenated once when accessed
+        if self._chunks[column]:
+            self._columns[column] = np.concatenate(
+                [self._columns[column]] + self._chunks[column])
+            self._chunks[column] = []
+        return self._columns[column]
+
+    ids = property(lambda self: self._column('ids'))
+    sizes = property(lambda self: self._column('sizes'))
+    dates = property(lambda self: self._column('dates'))
+    tzoffsets = property(lambda self: self._column('tzoffsets'))
+    folder_ids = property(lambda self: self._column('folder_ids'))
+    sender_ids = property(lambda self: self._column('sender_ids'))
+    flags = property(lambda self: self._column('flags'))
+    header_ends = property(lambda self: self._column('header_ends'))
+
+    def folder_id(self, mbx: str) -> int:
+        if mbx not in self.folders:
+            self.folders.append(mbx)
+        return self.folders.index(mbx)
+
+    def sender_id(self, sender: str) -> int:
+        sender_id = self._senders_ids.get(sender)
+        if sender_id is None:
+            sender_id = self._senders_ids[sender] = len(self.senders)
+            self.senders.append(sender)
+        return sender_id
+
+    def flag_bit(self, flag: str) -> int | None:
+        if flag not in self.flag_names:
+            if len(self.flag_names) == 64:
+                print(f"Too many IMAP flags, ignoring {flag} (MessagesStore)")
+                return None
+            self.flag_names.append(flag)
+        return self.flag_names.index(flag)
+
+    def flags_mask(self, flags: tuple[str, ...]) -> int:
+        # Few distinct flags combinations: cache their masks
+        mask = self._flags_masks.get(flags)
+        if mask is None:
+            mask = 0
+            for flag in flags:
+                bit = self.flag_bit(flag)
+                if bit is not None:
+                    mask |= 1 << bit
+            self._flags_masks[flags] = mask
+        return mask
+
+    def flags_string(self, mask: int) -> str:
+        return ' '.join(
+            flag for bit, flag in enumerate(self.flag_names)
+            if mask & (1 << bit))
+
+    def unread(self) -> np.ndarray:
+        return (self.flags & np.uint64(1)) == 0
+
+    def append(
+        self,
+        mbx: str,
+        ids: np.ndarray,
+        sizes: np.ndarray,
+        dates: np.ndarray,
+        tzoffsets: np.ndarray,
+        flags: np.ndarray,
+        headers: list[bytes | None] = None,
+            ) -> None:
+        folder_id = self.folder_id(mbx)
+        header_ends = np.full(len(ids), len(self.headers_data), np.int64)
+        sender_ids = np.zeros(len(ids), np.uint32)
+        if headers:
+            # Same From headers are frequent, only parse them once
+            senders = {}
+            from_headers = [
+                headers_from(msg_headers) for msg_headers in headers]
+            for from_header in from_headers:
+                if from_header not in senders:
+                    senders[from_header] = self.sender_id(
+                        from_address(from_header))
+            sender_ids = np.fromiter(
+                (senders[from_header] for from_header in from_headers),
+                np.uint32, len(ids))
+            header_ends += np.cumsum(np.fromiter(
+                (len(msg_headers) if msg_headers else 0
+                 for msg_headers in headers), np.int64, len(ids)))
+            self.headers_data += b''.join(
+                msg_headers for msg_headers in headers if msg_headers)
+        for column, values in (
+                ('ids', ids),
+                ('sizes', sizes),
+                ('dates', dates),
+                ('tzoffsets', tzoffsets),
+                ('flags', flags),
+                ('folder_ids', np.full(len(ids), folder_id)),
+                ('sender_ids', sender_ids),
+                ('header_ends', header_ends)):
+            self._chunks[column].append(
+                np.asarray(values, dtype=self.dtypes[column]))
+
+    def extend(self, other: 'MessagesStore') -> None:
+        # Folders and senders indexes and flags bits must be renumbered
+        folders_map = np.array(
+            [self.folder_id(mbx) for mbx in other.folders] or [0],
+            dtype=np.uint32)
+        senders_map = np.array(
+            [self.sender_id(sender) for sender in other.senders],
+            dtype=np.uint32)
+        flags = np.zeros(len(other), np.uint64)
+        for bit, flag in enumerate(other.flag_names):
+            new_bit = self.flag_bit(flag)
+            if new_bit is not None:
+                flags[(other.flags & np.uint64(1 << bit)) != 0] |= \
+                    np.uint64(1 << new_bit)
+        for column, values in (
+                ('ids', other.ids),
+                ('sizes', other.sizes),
+                ('dates', other.dates),
+                ('tzoffsets', other.tzoffsets),
+                ('flags', flags),
+                ('folder_ids', folders_map[other.folder_ids]),
+                ('sender_ids', senders_map[other.sender_ids]),
+                ('header_ends',
+                 other.header_ends + len(self.headers_data))):
+            self._chunks[column].append(values)
+        self.headers_data += other.headers_data
+
+    def date(self, index: int) -> datetime | None:
+        if np.isnat(self.dates[index]):
+            return None
+        return datetime.fromtimestamp(
+            int(self.dates[index].astype(np.int64)),
+            timezone(timedelta(minutes=int(self.tzoffsets[index]))))
+
+    def dates_range(self) -> tuple[datetime | None, datetime | None]:
+        valid = np.flatnonzero(~np.isnat(self.dates))
+        if len(valid) == 0:
+            return None, None
+        return (
+            self.date(valid[np.argmin(self.dates[valid])]),
+            self.date(valid[np.argmax(self.dates[valid])]))
+
+    def headers(self, index: int) -> bytes | None:
+        start = int(self.header_ends[index - 1]) if index > 0 else 0
+        return bytes(
+            self.headers_data[start:int(self.header_ends[index])]) or None
+
+    def message(self, index: int) -> dict[str, int | str | datetime]:
+        return {
+            'id': int(self.ids[index]),
+            'size': int(self.sizes[index]),
+            'date': self.date(index),
+            'flags': self.flags_string(int(self.flags[index])).split(),
+            'folder': self.folders[self.folder_ids[index]],
+            'headers': self.headers(index),
+            }
+
+    def dates_strings(self, indexes: np.ndarray = None) -> np.ndarray:
+        # Same format as str(datetime) with its UTC offset
+        if indexes is None:
+            indexes = np.arange(len(self))
+        dates = self.dates[indexes]
+        tzoffsets = self.tzoffsets[indexes]
+        local_dates = np.char.replace(np.datetime_as_string(
+            dates + tzoffsets.astype('timedelta64[m]'), unit='s'), 'T', ' ')
+        offsets = {
+            offset: "%s%02d:%02d" % (
+                '-' if offset < 0 else '+',
+                abs(int(offset)) // 60, abs(int(offset)) % 60)
+            for offset in np.unique(tzoffsets)}
+        suffixes = np.array(
+            [offsets[offset] for offset in tzoffsets] or [''])[:len(dates)]
+        return np.where(
+            np.isnat(dates), '', np.char.add(local_dates, suffixes))
+
+    def rows(
+        self,
+        indexes: np.ndarray = None,
+            ) -> Iterator[list[int | str]]:
+        # Rows for CSV output, folders names being decoded only once
+        if indexes is None:
+            indexes = np.arange(len(self))
+        folders_names = [mailbox_real_name(mbx)
+                         for mbx in self.folders]
+        flags_strings = {}
+        for msg_id, msg_size, msg_date, msg_flags, folder_id in zip(
+                self.ids[indexes].tolist(),
+                self.sizes[indexes].tolist(),
+                self.dates_strings(indexes).tolist(),
+                self.flags[indexes].tolist(),
+                self.folder_ids[indexes].tolist()):
+            if msg_flags not in flags_strings:
+                flags_strings[msg_flags] = self.flags_string(msg_flags)
+            yield [msg_id, msg_size, msg_date, flags_strings[msg_flags],
+                   folders_names[folder_id]]
+
+
+class MessagesSummary:
+    # Mergeable messages sizes and dates distributions, built per folder
+    # then merged: power of 2 sizes histogram, monthly dates histogram and
+    # a DDSketch like quantile sketch (logarithmic buckets, any quantile
+    # being estimated within relative_accuracy of the actual size)
+    relative_accuracy = 0.01
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+
+    def __init__(self):
+        self.count = 0
+        self.size = 0
+        self.min_size = None
+        self.max_size = None
+        # (seconds since epoch, UTC offset in minutes)
+        self.min_date = None
+        self.max_date = None
+        # Bucket (log2 of the sizes, months since 1970-01): [count, size]
+        self.sizes_histogram = {}
+        self.months_histogram = {}
+        # Bucket (log gamma of the sizes): count
+        self.sketch = {}
+
+    @staticmethod
+    def _add_buckets(
+        histogram: dict[int, list[int]],
+        buckets: np.ndarray,
+        sizes: np.ndarray,
+            ) -> None:
+        keys, inverse = np.unique(buckets, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(keys))
+        sizes = np.bincount(inverse, weights=sizes, minlength=len(keys))
+        for key, count, size in zip(
+                keys.tolist(), counts.tolist(), sizes.tolist()):
+            bucket = histogram.setdefault(key, [0, 0])
+            bucket[0] += count
+            bucket[1] += int(size)
+
+    def _add_extrema(self, min_size: int, max_size: int) -> None:
+        if self.min_size is None:
+            self.min_size, self.max_size = min_size, max_size
+        else:
+            self.min_size = min(self.min_size, min_size)
+            self.max_size = max(self.max_size, max_size)
+
+    def _add_dates(
+        self,
+        min_date: tuple[int, int] | None,
+        max_date: tuple[int, int] | None,
+            ) -> None:
+        # First seen date kept on ties
+        if min_date and (not self.min_date or min_date[0] < self.min_date[0]):
+            self.min_date = min_date
+        if max_date and (not self.max_date or max_date[0] > self.max_date[0]):
+            self.max_date = max_date
+
+    def add(
+        self,
+        sizes: np.ndarray,
+        dates: np.ndarray,
+        tzoffsets: np.ndarray,
+            ) -> None:
+        if len(sizes) == 0:
+            return
+        self.count += len(sizes)
+        self.size += int(sizes.sum())
+        self._add_extrema(int(sizes.min()), int(sizes.max()))
+        valid = np.flatnonzero(~np.isnat(dates))
+        if len(valid):
+            self._add_dates(*(
+                (int(dates[index].astype(np.int64)), int(tzoffsets[index]))
+                for index in (valid[np.argmin(dates[valid])],
+                              valid[np.argmax(dates[valid])])))
+        log_sizes = np.log(np.maximum(sizes, 1))
+        self._add_buckets(
+            self.sizes_histogram,
+            np.floor(log_sizes / np.log(2)).astype(np.int64), sizes)
+        known_dates = ~np.isnat(dates)
+        self._add_buckets(
+            self.months_histogram,
+            dates[known_dates].astype('datetime64[M]').astype(np.int64),
+            sizes[known_dates])
+        keys, counts = np.unique(
+            np.ceil(log_sizes / np.log(self.gamma)).astype(np.int64),
+            return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.sketch[key] = self.sketch.get(key, 0) + count
+
+    def merge(self, other: 'MessagesSummary') -> None:
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.size += other.size
+        self._add_extrema(other.min_size, other.max_size)
+        self._add_dates(other.min_date, other.max_date)
+        for histogram, other_histogram in (
+                (self.sizes_histogram, other.sizes_histogram),
+                (self.months_histogram, other.months_histogram)):
+            for key, (count, size) in other_histogram.items():
+                bucket = histogram.setdefault(key, [0, 0])
+                bucket[0] += count
+                bucket[1] += size
+        for key, count in other.sketch.items():
+            self.sketch[key] = self.sketch.get(key, 0) + count
+
+    def quantile(self, q: float) -> int | None:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.sketch):
+            seen += self.sketch[key]
+            if seen > rank:
+                break
+        # Middle of the bucket relatively to its bounds
+        estimate = round(2 * self.gamma ** key / (self.gamma + 1))
+        return min(max(estimate, self.min_size), self.max_size)
+
+    def dates_range(self) -> tuple[datetime | None, datetime | None]:
+        return tuple(
+            datetime.fromtimestamp(
+                date[0], timezone(timedelta(minutes=date[1])))
+            if date else None
+            for date in (self.min_date, self.max_date))
+
+    def sizes_rows(self) -> list[list[str | int | float]]:
+        return [
+            [f"{human_readable_size(1 << key)} - " +
+             f"{human_readable_size(1 << (key + 1))}",
+             count, (100.0 * count) / self.count,
+             size, (100.0 * size) / (self.size or 1)]
+            for key, (count, size) in sorted(self.sizes_histogram.items())]
+
+    def months_rows(
+        self,
+        months_per_row: int = 1,
+            ) -> list[list[str | int | float]]:
+        # Yearly rows with 12 months per row
+        rows = {}
+        for key, (count, size) in self.months_histogram.items():
+            row = rows.setdefault(key - key % months_per_row, [0, 0])
+            row[0] += count
+            row[1] += size
+        return [
+            [str(np.datetime64(key, 'M').astype(
+                'datetime64[Y]' if months_per_row == 12 else 'datetime64[M]')),
+             count, (100.0 * count) / self.count,
+             size, (100.0 * size) / (self.size or 1)]
+            for key, (count, size) in sorted(rows.items())]
+
+
+class BiggestMessages:
+    # Bounded selection of the biggest messages: the count biggest ones of
+    # each folder are kept, folders selections being merged in a min-heap
+    # of the count biggest overall. Among messages of the same size the
+    # first added ones (LIST then UID order) are kept and listed first
+    def __init__(self, count: int):
+        self.count = count
+        self.added = 0
+        # (size, -addition order, message)
+        self.heap = []
+
+    def add(self, message: dict[str, int | str | datetime]) -> None:
+        self.added += 1
+        item = (message['size'], -self.added, message)
+        if len(self.heap) < self.count:
+            heapq.heappush(self.heap, item)
+        elif item[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, item)
+
+    def add_folder(self, messages: MessagesStore) -> None:
+        sizes = messages.sizes
+        if len(sizes) > self.count:
+            # Partial selection, lowest UIDs first at the threshold size
+            threshold = np.partition(sizes, len(sizes) - self.count)[
+                len(sizes) - self.count]
+            above = np.flatnonzero(sizes > threshold)
+            indexes = np.sort(np.concatenate((
+                above,
+                np.flatnonzero(sizes == threshold)[
+                    :self.count - len(above)])))
+        else:
+            indexes = np.arange(len(sizes))
+        for index in indexes:
+            self.add(messages.message(index))
+
+    def merge(self, other: 'BiggestMessages') -> None:
+        for _, _, message in sorted(
+                other.heap, key=lambda item: -item[1]):
+            self.add(message)
+
+    def messages(
+        self,
+        min_size: int = 0,
+            ) -> list[dict[str, int | str | datetime]]:
+        # By increasing size, only the ones bigger than min_size
+        return [
+            message for size, _, message in sorted(
+                self.heap, key=lambda item: (item[0], -item[1]))
+            if size > min_size]
+
+
+# Group-by keys of the messages and the age buckets bounds in years
+group_by_keys = ('sender', 'domain', 'folder', 'year', 'month', 'age')
+age_buckets = (1, 2, 5, 10)
+
+
+def group_by_codes(
+    messages: MessagesStore,
+    key: str,
+        ) -> tuple[np.ndarray, list[str]]:
+    # Dictionary encoded key of every message: codes array and the labels
+    # of the codes, '' (code 0 for dates) standing for unknown
+    if key == 'folder':
+        return messages.folder_ids, [
+            mailbox_real_name(mbx) for mbx in messages.folders]
+    if key == 'sender':
+        return messages.sender_ids, messages.senders
+    if key == 'domain':
+        domains = {}
+        senders_domains = np.fromiter(
+            (domains.setdefault(sender.rpartition('@')[2], len(domains))
+             for sender in messages.senders),
+            np.uint32, len(messages.senders))
+        return senders_domains[messages.sender_ids], list(domains)
+    dates = messages.dates
+    known_dates = ~np.isnat(dates)
+    if key == 'age':
+        ages = np.datetime64('now', 's').astype(np.int64) - \
+            dates[known_dates].astype(np.int64)
+        # Few buckets: comparisons are cheaper than a binary search
+        codes = np.zeros(len(dates), np.int64)
+        codes[known_dates] = 1 + sum(
+            (ages >= years * (365 * 86400 + 6 * 3600)).astype(np.int64)
+            for years in age_buckets)
+        return codes, [''] + [
+            f"< {age_buckets[0]} year"] + [
+            f"{low}-{high} years"
+            for low, high in zip(age_buckets, age_buckets[1:])] + [
+            f">= {age_buckets[-1]} years"]
+    if key in ('year', 'month'):
+        unit = 'Y' if key == 'year' else 'M'
+        days = dates[known_dates].astype('datetime64[D]').astype(np.int64)
+        if len(days) == 0:
+            return np.zeros(len(dates), np.int64), ['']
+        # Calendar conversion of the distinct days only
+        first_day = days.min()
+        periods = np.arange(first_day, days.max() + 1).astype(
+            'datetime64[D]').astype(f'datetime64[{unit}]').astype(
+            np.int64)[days - first_day]
+        first = periods.min()
+        codes = np.zeros(len(dates), np.int64)
+        codes[known_dates] = periods - first + 1
+        return codes, [''] + [
+            str(np.datetime64(period, unit))
+            for period in range(first, periods.max() + 1)]
+    raise ValueError(f"Unknown group-by key {key}, expecting one of " +
+                     ", ".join(group_by_keys))
+
+
+def group_messages(
+    messages: MessagesStore,
+    keys: list[str],
+        ) -> list[list[str | int | float]]:
+    # Columns of the keys values, messages count, unread count, size,
+    # unread size and size% of each group, biggest groups first (columns
+    # rather than rows: there may be millions of groups). The keys codes
+    # are combined in a single integer code: groups are its distinct values
+    codes = np.zeros(len(messages), np.int64)
+    keys_labels = []
+    for key in keys:
+        key_codes, key_labels = group_by_codes(messages, key)
+        codes = codes * len(key_labels) + key_codes
+        keys_labels.append(key_labels)
+    # Dense codes are directly counted, sparse ones sorted first
+    ncodes = int(np.prod([len(labels) for labels in keys_labels]))
+    if ncodes <= max(4 * len(codes), 1 << 16):
+        inverse = codes
+        groups = np.flatnonzero(np.bincount(codes, minlength=ncodes))
+    else:
+        groups, inverse = np.unique(codes, return_inverse=True)
+    nslots = ncodes if inverse is codes else len(groups)
+    sizes = messages.sizes
+    unread = messages.unread()
+    columns = [
+        np.bincount(inverse, minlength=nslots),
+        np.bincount(inverse[unread], minlength=nslots),
+        np.bincount(inverse, weights=sizes, minlength=nslots),
+        np.bincount(inverse[unread], weights=sizes[unread], minlength=nslots),
+        ]
+    if inverse is codes:
+        columns = [column[groups] for column in columns]
+    order = np.argsort(-columns[2], kind='stable')
+    groups = groups[order]
+    columns = [column[order].astype(np.int64) for column in columns]
+    columns.append((100.0 * columns[2]) / (int(sizes.sum()) or 1))
+    # Codes split back to their keys labels
+    labels_columns = []
+    for key_labels in reversed(keys_labels):
+        groups, key_codes = np.divmod(groups, len(key_labels))
+        labels_columns.insert(0, np.array(
+            [label or '(unknown)' for label in key_labels],
+            dtype=object)[key_codes].tolist())
+    return labels_columns + [column.tolist() for column in columns]
+
+
+class MessagesCsvExport:
+    # Messages CSV written folder by folder as soon as each one is
+    # scanned. A journal records every exported folder with its rows
+    # offsets so that an interrupted export can be resumed: exported
+    # folders are read back from the CSV instead of being scanned again
+    flush_rows = 10000
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.lock = threading.Lock()
+        self.exported = []
+        if resume and not os.path.exists(self.journal_path) and \
+                os.path.exists(path):
+            # Complete export (journal removed) or not one of ours: not
+            # overwritten
+            raise Exception(f"{path} can not be resumed, no " +
+                            f"{self.journal_path} journal")
+        if resume and os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding='utf-8') as f:
+                self.exported = [json.loads(line) for line in f
+                                 if line.endswith('\n')]
+        if self.exported:
+            # Rows of a folder being exported when interrupted are dropped
+            self.file = open(path, 'r+b')
+            self.file.truncate(self.exported[-1]['end'])
+            self.file.seek(self.exported[-1]['end'])
+            self.journal = open(self.journal_path, 'w', encoding='utf-8')
+            for entry in self.exported:
+                self.journal.write(json.dumps(entry) + '\n')
+        else:
+            self.file = open(path, 'wb')
+            self.journal = open(self.journal_path, 'w', encoding='utf-8')
+            self._write_rows([MessagesStore.columns])
+
+    def _write_rows(self, rows: Iterator[list]) -> None:
+        # Rows are formatted by chunks, the file being flushed after each
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter='|')
+        for count, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if count % self.flush_rows == 0:
+                self.file.write(buffer.getvalue().encode('utf-8'))
+                self.file.flush()
+                buffer.seek(0)
+                buffer.truncate()
+        self.file.write(buffer.getvalue().encode('utf-8'))
+        self.file.flush()
+
+    def write_folder(self, folder_infos: dict) -> None:
+        if 'infos' not in folder_infos:
+            return
+        with self.lock:
+            start = self.file.tell()
+            self._write_rows(folder_infos['infos'].rows())
+            # Rows must be on disk before being referenced by the journal
+            os.fsync(self.file.fileno())
+            entry = {
+                key: folder_infos.get(key)
+                for key in ('mailbox', 'name', 'messages', 'unread', 'size',
+                            'uidvalidity')}
+            entry.update(start=start, end=self.file.tell())
+            self.journal.write(json.dumps(entry) + '\n')
+            self.journal.flush()
+
+    def exported_folders(self) -> dict[str, dict]:
+        # Folders infos of a resumed export, indexed by IMAP folder name
+        folders_infos = {}
+        for entry in self.exported:
+            self.file.seek(entry['start'])
+            lines = self.file.read(entry['end'] - entry['start']).decode(
+                'utf-8').splitlines()
+            messages = MessagesStore()
+            ids, sizes, dates, tzoffsets, flags = [], [], [], [], []
+            for msg_id, msg_size, msg_date, msg_flags, _ in csv.reader(
+                    lines, delimiter='|'):
+                ids.append(int(msg_id))
+                sizes.append(int(msg_size))
+                msg_date = datetime.fromisoformat(msg_date) if msg_date \
+                    else None
+                dates.append(int(msg_date.timestamp()) if msg_date
+                             else np.datetime64('NaT'))
+                tzoffsets.append(
+                    msg_date.utcoffset() // timedelta(minutes=1)
+                    if msg_date else 0)
+                flags.append(messages.flags_mask(tuple(msg_flags.split())))
+            messages.append(
+                entry['mailbox'], ids, sizes,
+                np.array(dates, 'datetime64[s]'), tzoffsets, flags)
+            messages_summary = MessagesSummary()
+            messages_summary.add(
+                messages.sizes, messages.dates, messages.tzoffsets)
+            biggest_messages = BiggestMessages(biggest_count)
+            biggest_messages.add_folder(messages)
+            folders_infos[entry['mailbox']] = dict(
+                {key: entry[key] for key in (
+                    'mailbox', 'name', 'messages', 'unread', 'size',
+                    'uidvalidity')},
+                infos=messages,
+                summary=messages_summary,
+                biggest=biggest_messages)
+        self.file.seek(0, os.SEEK_END)
+        return folders_infos
+
+    def close(self, complete: bool = True) -> None:
+        # The journal is only kept for resuming an incomplete export
+        self.file.close()
+        self.journal.close()
+        if complete:
+            os.remove(self.journal_path)
 
 
 # Some regular expressions for IMAP response decoding
-# TODO: better use r"^\([^)]*\) \"([^\"]+)\" \"(.*)\"$")
-# to segment flags, separator, folder_name
-imap_folder_re = re.compile(r"^\([^)]*\) (.*)$")
+# LIST response: flags, hierarchy delimiter, folder name (and extended data)
+imap_list_re = re.compile(
+    rb'^\((?P<flags>[^)]*)\) (?P<delimiter>NIL|"(?:[^"\\]|\\.)*") (?P<name>.*)$',
+    re.IGNORECASE)
+imap_quoted_re = re.compile(rb'"((?:[^"\\]|\\.)*)"')
+imap_literal_re = re.compile(rb'\{(\d+)\}$')
+# Capabilities response code, as sent with the LOGIN completion
+imap_capability_code_re = re.compile(r'\[CAPABILITY ([^\]]*)\]', re.IGNORECASE)
 imap_quota_re = re.compile(r"^\"[^\"]*\" \(STORAGE (\d+) (\d+)\)$")
-imap_message_attributes = {
-    'ID': re.compile(r"^(\d+) \((.*)\)$"),
-    'SIZE': re.compile(r".*RFC822.SIZE (\d+).*"),
-    'DATE': re.compile(r".*INTERNALDATE \"([^\"]+)\".*"),
-    'FLAGS': re.compile(r".*FLAGS \(([^\)]+)\).*"),
-}
+# Single pass over a FETCH response: each match is one of the items
+imap_fetch_items_re = re.compile(
+    rb'\bUID (?P<uid>\d+)'
+    rb'|RFC822\.SIZE (?P<size>\d+)'
+    rb'|INTERNALDATE "(?P<date>[^"]*)"'
+    rb'|FLAGS \((?P<flags>[^)]*)\)'
+    rb'|MODSEQ \((?P<modseq>\d+)\)'
+    rb'|X-GM-MSGID (?P<gm_msgid>\d+)'
+    rb'|X-GM-LABELS \((?P<gm_labels>(?:[^()"]|"(?:[^"\\]|\\.)*")*)\)')
+# X-GM-LABELS list items: quoted strings or atoms
+gmail_labels_re = re.compile(rb'"((?:[^"\\]|\\.)*)"|([^\s"()]+)')
+# Raw From header (unfolded by from_address) and its address, the one
+# between angle brackets when there is a display name
+imap_from_header_re = re.compile(
+    rb'^From:[ \t]*([^\r\n]*(?:\r?\n[ \t][^\r\n]*)*)',
+    re.IGNORECASE | re.MULTILINE)
+email_angle_address_re = re.compile(rb'<\s*([^<>\s]+@[^<>\s]+?)\s*>')
+email_address_re = re.compile(rb'[^\s<>"(),;:]+@[^\s<>"(),;:]+')
+# Bytes of an INTERNALDATE item in a FETCH response
+internaldate_item_size = len(b' INTERNALDATE "dd-Mon-yyyy hh:mm:ss +zzzz"')
+internaldate_months = {
+    month: index + 1 for index, month in enumerate((
+        b'Jan', b'Feb', b'Mar', b'Apr', b'May', b'Jun',
+        b'Jul', b'Aug', b'Sep', b'Oct', b'Nov', b'Dec'))}
 
 # Define some constant for IMAP folders flags
 special_folder_flags = set((
@@ -63,7 +959,43 @@ known_folder_flags.update(special_folder_flags)
 
 # Other globalss
 imap_server = os.getenv("IMAP_SERVER") or "imap.gmail.com"
+imap_port = int(os.getenv("IMAP_PORT") or 993)
+imap_ssl = not os.getenv("IMAP_NO_SSL")
 detailed_infos = os.getenv("IMAP_DETAILS")
+detailed_header_fields = "FROM TO SUBJECT MESSAGE-ID"
+imap_workers = int(os.getenv("IMAP_WORKERS") or 1)
+folders_state_dir = os.getenv("IMAP_STATE_DIR")
+fetch_batch_size = int(os.getenv("IMAP_FETCH_BATCH") or 5000)
+folders_state_version = 2
+imap_async = os.getenv("IMAP_ASYNC")
+pipeline_depth = int(os.getenv("IMAP_PIPELINE_DEPTH") or 4)
+imap_overview = os.getenv("IMAP_OVERVIEW")
+messages_index_path = os.getenv("IMAP_INDEX")
+index_report = os.getenv("IMAP_INDEX_REPORT")
+imap_resume = os.getenv("IMAP_RESUME")
+biggest_count = int(os.getenv("IMAP_BIGGEST_COUNT") or 1000)
+biggest_percentile = float(os.getenv("IMAP_BIGGEST_PERCENTILE") or 95)
+batch_accounts = os.getenv("IMAP_ACCOUNTS")
+batch_processes = int(os.getenv("IMAP_BATCH_PROCESSES") or 4)
+server_connections = int(os.getenv("IMAP_SERVER_CONNECTIONS") or 8)
+imap_stats_output = os.getenv("IMAP_STATS")
+imap_timeout = float(os.getenv("IMAP_TIMEOUT") or 300)
+reconnect_attempts = int(os.getenv("IMAP_RECONNECT") or 3)
+keepalive_interval = float(os.getenv("IMAP_KEEPALIVE") or 60)
+group_by_reports = [
+    [key.strip() for key in report.split(',')]
+    for report in (os.getenv("IMAP_GROUP_BY") or '').split(';')
+    if report.strip()]
+group_by_rows = int(os.getenv("IMAP_GROUP_BY_ROWS") or 20)
+# Senders only come from the headers fetched by the current scan, neither
+# the folders state nor a resumed export keeps them
+group_by_senders = any(
+    key in ('sender', 'domain') for keys in group_by_reports for key in keys)
+local_source = os.getenv("IMAP_LOCAL")
+gmail_mode = os.getenv("IMAP_GMAIL")
+imap_compress = not os.getenv("IMAP_NO_COMPRESS")
+fetch_dates = not os.getenv("IMAP_NO_DATES")
+imap_stats = ImapStats()
 
 def trace_msg(msg):
     if os.getenv("NO_TRACE"):
@@ -86,140 +1018,733 @@ def folder_real_name(folder, decoded=True):
     return folder
 
 
-def message_subject_from_to(
-        cnx: imaplib.IMAP4_SSL,
-        msg: dict[str, str],
+def headers_from(headers: bytes | None) -> bytes:
+    match = imap_from_header_re.search(headers) if headers else None
+    return match.group(1) if match else b''
+
+
+def from_address(from_header: bytes) -> str:
+    # Lower case address of a raw From header, '' when there is none
+    match = email_angle_address_re.search(from_header)
+    if match:
+        return match.group(1).decode('ascii', 'replace').lower()
+    match = email_address_re.search(from_header)
+    if match:
+        return match.group(0).decode('ascii', 'replace').lower()
+    return ''
+
+
+def imap_quote(arg: str) -> str:
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def decode_subject_from_to(
+    mbx: str,
+    msg_id: int,
+    msg_headers: bytes,
         ) -> tuple[str, str, str]:
-    msg_id = msg.get('id')
-    mbx = msg.get('folder')
-    if not mbx or not msg_id:
-        print("Unable to retrieve folder for message " +
-              f"{msg.get('id')} in {msg.get('folder')}")
-        return "(None)", "(None)", "(None)"
+    try:
+        utf8_msg = email.message_from_string(msg_headers.decode('utf-8'))
+        # The IMAPlib module can return empty From/To/Subject headers
+        # therefore use get instead of dict keys
+        msg_from = str(
+            email.header.make_header(
+                email.header.decode_header(
+                    utf8_msg.get('From', '**NONE**')
+                    )))
+        msg_to = str(
+            email.header.make_header(
+                email.header.decode_header(
+                    utf8_msg.get('To', '**NONE**')
+                    )))
+        msg_subject = str(
+            email.header.make_header(
+                email.header.decode_header(
+                    utf8_msg.get('Subject', '**NONE**')
+                    )))
+        return msg_from, msg_to, msg_subject
+    except Exception as e:
+        print(f"{mbx} IMAP folder message {msg_id} " +
+              f"can not decode: {e}")
+    return "(None)", "(None)", "(None)"
+
+
+def decode_messages_headers(
+    mbx: str,
+    headers: dict[int, bytes],
+        ) -> list[tuple[str, str, str]]:
+    with imap_stats.timed('headers', mbx):
+        return [
+            decode_subject_from_to(mbx, msg_id, msg_headers)
+            for msg_id, msg_headers in headers.items()]
+
+
+def fetch_messages_headers(
+    cnx: imaplib.IMAP4_SSL,
+    mbx: str,
+    msg_ids: list[int],
+        ) -> dict[int, bytes]:
+    if isinstance(cnx, LocalMailSource):
+        return cnx.fetch_headers(mbx, msg_ids)
     result, nb = cnx.select(mbx, readonly=1)
     if result != 'OK':
         print(f"{mbx} IMAP folder select returned {result} " +
-              "(message_subject_from_to)")
-        return "(None)", "(None)", "(None)"
-    # Only retrieve mail headers for faster computation
-    result, msg_data = cnx.fetch(str(msg_id), "(RFC822.HEADER)")
+              "(fetch_messages_headers)")
+        return {}
+    headers = {}
+    msg_ids = sorted(msg_ids)
+    # Keep the FETCH command line reasonably short
+    for i in range(0, len(msg_ids), 500):
+        uidset = ','.join(map(str, msg_ids[i:i + 500]))
+        # Only retrieve the needed mail headers for faster computation
+        result, msg_data = cnx.uid(
+            'FETCH', uidset, "(UID BODY.PEEK[HEADER.FIELDS (FROM TO SUBJECT)])")
+        if result != 'OK':
+            print(f"{mbx} IMAP folder fetch {uidset} returned {result}")
+            continue
+        for msg in parse_fetch_responses(msg_data):
+            if msg.uid is not None and msg.headers is not None:
+                headers[msg.uid] = msg.headers
+    return headers
+
+
+def messages_subject_from_to(
+    cnx: imaplib.IMAP4_SSL,
+    messages: list[dict[str, int | str]],
+    progress: Progress = None,
+        ) -> dict[tuple[str, int], tuple[str, str, str]]:
+    # Select each folder once and fetch all its messages headers in a
+    # single command. Decoding is done in a separate thread while the
+    # next folder headers are retrieved
+    folders_messages = {}
+    for msg in messages:
+        folders_messages.setdefault(msg.get('folder'), []).append(
+            msg.get('id'))
+    if progress:
+        main_folder_task = progress.add_task(
+            "[yellow]Processing biggest messages...",
+            total=len(messages))
+    decoded_headers = {}
+    with ThreadPoolExecutor(max_workers=1) as decoder:
+        decoding = []
+        for mbx, msg_ids in folders_messages.items():
+            headers = fetch_messages_headers(cnx, mbx, msg_ids)
+            decoding.append((mbx, headers, decoder.submit(
+                decode_messages_headers, mbx, headers)))
+            if progress:
+                progress.update(main_folder_task, advance=len(msg_ids))
+        # Connection idle until the decoding is over
+        with cnx.keepalive():
+            for mbx, headers, future in decoding:
+                for msg_id, decoded in zip(headers, future.result()):
+                    decoded_headers[(mbx, msg_id)] = decoded
+    return decoded_headers
+
+
+class FetchRecord(NamedTuple):
+    seq: int
+    uid: int | None = None
+    size: int | None = None
+    # Raw INTERNALDATE, see decode_internaldates
+    date: bytes | None = None
+    flags: tuple[str, ...] | None = None
+    modseq: int | None = None
+    headers: bytes | None = None
+    # Gmail mode (X-GM-EXT-1) message id and labels
+    gm_msgid: int | None = None
+    gm_labels: tuple[str, ...] | None = None
+
+
+# Distinct flags and labels lists are few, only decode them once
+fetch_flags_cache: dict[bytes, tuple[str, ...]] = {}
+fetch_labels_cache: dict[bytes, tuple[str, ...]] = {}
+
+
+def parse_fetch_items(
+    data: bytes,
+    seq: int,
+    headers: bytes = None,
+    record: FetchRecord = None,
+        ) -> FetchRecord:
+    # Items already parsed before a literal are completed by the ones
+    # following it
+    if record:
+        uid, size, msg_date, flags, modseq = record[1:6]
+        gm_msgid, gm_labels = record[7:9]
+    else:
+        uid = size = msg_date = flags = modseq = None
+        gm_msgid = gm_labels = None
+    for item in imap_fetch_items_re.finditer(data):
+        name = item.lastgroup
+        value = item[name]
+        if name == 'uid':
+            uid = int(value)
+        elif name == 'size':
+            size = int(value)
+        elif name == 'date':
+            msg_date = value
+        elif name == 'flags':
+            flags = fetch_flags_cache.get(value)
+            if flags is None:
+                flags = tuple(str(value, 'utf-8').split())
+                fetch_flags_cache[value] = flags
+        elif name == 'modseq':
+            modseq = int(value)
+        elif name == 'gm_msgid':
+            gm_msgid = int(value)
+        else:
+            gm_labels = fetch_labels_cache.get(value)
+            if gm_labels is None:
+                # Labels are modified UTF-7 mailbox names, as quoted names
+                gm_labels = tuple(
+                    str(re.sub(rb'\\(.)', rb'\1', quoted), 'utf-8')
+                    if quoted else str(atom, 'utf-8')
+                    for quoted, atom in gmail_labels_re.findall(value))
+                fetch_labels_cache[value] = gm_labels
+    return FetchRecord(seq, uid, size, msg_date, flags, modseq, headers,
+                       gm_msgid, gm_labels)
+
+
+def parse_fetch_responses(
+    response: list[bytes | tuple[bytes, bytes]],
+        ) -> Iterator[FetchRecord]:
+    # Walk an imaplib FETCH response: plain "seq (items)" lines, or
+    # (b"seq (items BODY[...] {n}", literal) tuples possibly followed by a
+    # b" items)" element holding the items sent after the literal
+    record = None
+    for part in response:
+        if isinstance(part, tuple):
+            if record:
+                yield record
+            data, headers = part
+        elif not part:
+            continue
+        elif not part[:1].isdigit():
+            # Items following the literal of the previous response
+            if record:
+                yield parse_fetch_items(
+                    part, record.seq, record.headers, record)
+                record = None
+            continue
+        else:
+            if record:
+                yield record
+                record = None
+            data, headers = part, None
+        seq = data[:data.find(b' ')]
+        if not seq.isdigit():
+            # TODO: set how to report this upstream
+            print(f"Error parsing {data} (parse_fetch_responses)")
+            continue
+        record = parse_fetch_items(data, int(seq), headers)
+        if headers is None:
+            yield record
+            record = None
+    if record:
+        yield record
+
+
+# Months numbers indexed by the 5 low bits of their 3 letters (case
+# insensitive), 0 for anything else
+internaldate_months_table = np.zeros(1 << 15, np.int64)
+for month, number in internaldate_months.items():
+    internaldate_months_table[
+        ((month[0] & 31) << 10) | ((month[1] & 31) << 5) | (month[2] & 31)
+        ] = number
+internaldate_months_days = np.array(
+    [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+# Expected characters of dd-Mon-yyyy hh:mm:ss +zzzz, digits being 0
+internaldate_template = np.frombuffer(
+    b'\0\0-Mon-\0\0\0\0 \0\0:\0\0:\0\0 +\0\0\0\0\0', np.uint8)
+internaldate_digits = internaldate_template == 0
+internaldate_digits[[0, 26]] = False
+internaldate_separators = np.isin(internaldate_template, list(b'-: '))
+internaldate_nat = np.datetime64('NaT').astype(np.int64)
+
+
+def decode_internaldates(
+    values: list[bytes | None],
+        ) -> tuple[np.ndarray, np.ndarray]:
+    # INTERNALDATE strings of a whole FETCH batch decoded at once into
+    # UTC dates and UTC offsets in minutes, NaT when missing or invalid.
+    # dd-Mon-yyyy hh:mm:ss +zzzz, the day being space padded (or, from a
+    # few servers, a single digit)
+    count = len(values)
+    chars = np.array([value or b'' for value in values], 'S27').view(
+        np.uint8).reshape(count, 27)
+    single_digit_day = (chars[:, 25] == 0) & (chars[:, 24] != 0)
+    if single_digit_day.any():
+        chars[single_digit_day, 1:] = chars[single_digit_day, :-1]
+        chars[single_digit_day, 0] = ord(' ')
+    digits = chars - np.uint8(ord('0'))
+    letters = chars[:, 3:6] | np.uint8(0x20)
+    valid = (
+        ((digits < 10) | ~internaldate_digits).all(axis=1) &
+        ((chars == internaldate_template) | ~internaldate_separators
+         ).all(axis=1) &
+        ((letters >= ord('a')) & (letters <= ord('z'))).all(axis=1) &
+        ((digits[:, 0] < 10) | (chars[:, 0] == ord(' '))) &
+        ((chars[:, 21] == ord('+')) | (chars[:, 21] == ord('-'))) &
+        (chars[:, 26] == 0))
+    digits = digits.astype(np.int64)
+    day = np.where(chars[:, 0] == ord(' '), 0, digits[:, 0]) * 10 + \
+        digits[:, 1]
+    month = internaldate_months_table[
+        ((chars[:, 3] & 31).astype(np.int64) << 10) |
+        ((chars[:, 4] & 31).astype(np.int64) << 5) |
+        (chars[:, 5] & 31)]
+    year = digits[:, 7] * 1000 + digits[:, 8] * 100 + digits[:, 9] * 10 + \
+        digits[:, 10]
+    hour = digits[:, 12] * 10 + digits[:, 13]
+    minute = digits[:, 15] * 10 + digits[:, 16]
+    second = digits[:, 18] * 10 + digits[:, 19]
+    offset = digits[:, 22] * 600 + digits[:, 23] * 60 + \
+        digits[:, 24] * 10 + digits[:, 25]
+    offset = np.where(chars[:, 21] == ord('-'), -offset, offset)
+    leap_year = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = internaldate_months_days[month] + ((month == 2) & leap_year)
+    valid &= (month > 0) & (day >= 1) & (day <= month_days) & \
+        (hour < 24) & (minute < 60) & (second <= 60) & (digits[:, 24] < 6)
+    # Days since epoch of the proleptic Gregorian date, March based years
+    # putting leap days at their end
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    days = era * 146097 + year_of_era * 365 + year_of_era // 4 - \
+        year_of_era // 100 + day_of_year - 719468
+    seconds = days * 86400 + hour * 3600 + minute * 60 + second - offset * 60
+    return (
+        np.where(valid, seconds, internaldate_nat).view('datetime64[s]'),
+        np.where(valid, offset, 0).astype(np.int16))
+
+
+def store_fetched_messages(
+    batch: list[FetchRecord],
+    messages: dict[int, tuple[int, tuple[int, int], tuple[str, ...]]],
+        ) -> None:
+    # Skip unsolicited FETCH responses (flags updates)
+    batch = [msg for msg in batch
+             if msg.uid is not None and msg.size is not None]
+    imap_stats.record_fetched(len(batch))
+    dates, tzoffsets = decode_internaldates([msg.date for msg in batch])
+    for msg, msg_date, msg_tzoffset in zip(
+            batch, dates.view(np.int64).tolist(), tzoffsets.tolist()):
+        value = (
+            msg.size,
+            None if msg_date == internaldate_nat else (msg_date, msg_tzoffset),
+            msg.flags or ())
+        # Raw headers of the detailed mode as a 4th item, Gmail message id
+        # and labels as 5th and 6th ones
+        if msg.gm_msgid is not None:
+            value += (msg.headers, msg.gm_msgid, msg.gm_labels or ())
+        elif msg.headers is not None:
+            value += (msg.headers,)
+        messages[msg.uid] = value
+
+
+def select_response_code(
+    cnx: imaplib.IMAP4_SSL,
+    code: str,
+        ) -> int | None:
+    # Numeric response codes (UIDVALIDITY, UIDNEXT, ...) of last SELECT
+    _, data = cnx.response(code)
+    if data and data[-1]:
+        return int(data[-1])
+    return None
+
+
+def fetch_messages_batch(
+    cnx: imaplib.IMAP4_SSL,
+    mbx: str,
+    uidset: str,
+    items: str,
+        ) -> list[FetchRecord]:
+    result, response = cnx.uid('FETCH', uidset, items)
     if result != 'OK':
-        print(f"{mbx} IMAP folder fetch {msg_id} returned {result}")
-        return "(None)", "(None)", "(None)"
-    # Only keep the proper typed results
-    for response_part in filter(lambda x: isinstance(x, tuple), msg_data):
-        # Should always be true but for more safety
-        if isinstance(response_part, tuple):
-            try:
-                utf8_msg = email.message_from_string(
-                    response_part[1].decode('utf-8'),
-                    )
-                # The IMAPlib module can return empty From/To/Subject headers
-                # therefore use get instead of dict keys
-                msg_from = str(
-                    email.header.make_header(
-                        email.header.decode_header(
-                            utf8_msg.get('From', '**NONE**')
-                            )))
-                msg_to = str(
-                    email.header.make_header(
-                        email.header.decode_header(
-                            utf8_msg.get('To', '**NONE**')
-                            )))
-                msg_subject = str(
-                    email.header.make_header(
-                        email.header.decode_header(
-                            utf8_msg.get('Subject', '**NONE**')
-                            )))
-                return msg_from, msg_to, msg_subject
-            except Exception as e:
-                print(f"{mbx} IMAP folder message {msg_id} " +
-                      f"can not decode: {e}")
-    return "(None)", "(None)", "(None)"
+        raise Exception(f"{mbx} IMAP messages fetch returned {result} " +
+                        "(fetch_messages_batch)")
+    with imap_stats.timed('parse', mbx):
+        return list(parse_fetch_responses(response))
+
+
+def fetch_messages_batches(
+    cnx: imaplib.IMAP4_SSL,
+    mbx: str,
+    uidset: str,
+    items: str,
+    batch_size: int = None,
+        ) -> Iterator[list[FetchRecord]]:
+    # Split the FETCH in bounded UID ranges so that only one batch of
+    # responses is buffered at a time by imaplib
+    result, uids = cnx.uid('SEARCH', 'UID', uidset)
+    if result != 'OK':
+        raise Exception(f"{mbx} IMAP folder search returned {result} " +
+                        "(fetch_messages_batches)")
+    uids = sorted(int(x) for x in (uids[0] or b'').split())
+    batch_size = batch_size or fetch_batch_size
+    for i in range(0, len(uids), batch_size):
+        # No other UID exists between the first and last of the batch
+        batch = uids[i:i + batch_size]
+        yield fetch_messages_batch(cnx, mbx, f"{batch[0]}:{batch[-1]}", items)
 
 
-def parse_message_basic_attributes(in_imap_email_infos: str | tuple[str]) -> dict[str, str]:
-    imap_email_infos = None
-    if type(in_imap_email_infos) is tuple:
-        # Here the first tuple element potentially missing the closing parenthesis
-        # because it is retrieved as a separate single element
-        imap_email_infos = str(in_imap_email_infos[0] + b')', 'utf-8')
+def messages_fetch_items() -> str:
+    # Add FLAGS to previously returned messages attributes
+    # Same as FAST. See https://www.rfc-editor.org/rfc/rfc3501#section-6.4.5
+    # DO NOT USE RFC822.HEADER which is untagged + INTERNALDATE not returned either
+    # Without dates reports, INTERNALDATE is about 40% of each response
+    if not fetch_dates:
+        items = "RFC822.SIZE FLAGS"
     else:
-        if in_imap_email_infos == b')':
-            return {}
-        imap_email_infos = str(in_imap_email_infos, 'utf-8')
-    m_attrs = imap_message_attributes['ID'].match(imap_email_infos)
-    # TODO: set how to report this upstream
-    if not m_attrs:
-        print(f"Error parsing {imap_email_infos} " +
-              "(parse_message_basic_attributes)")
-        return {}
-    ret = {'ID': m_attrs[1]}
-    for attr in ['FLAGS', 'SIZE', 'DATE']:
-        c_attr = imap_message_attributes[attr].match(m_attrs[2])
-        if c_attr:
-            ret[attr] = c_attr[1]
-    if type(in_imap_email_infos) is tuple:
-        # The second tuple element contains the email message headers
-        # as a bytes sequence. First remove the trailing double
-        # \r\n then for all continuation lines \r\n\s+ treat as single
-        # space without going to the next list. Once done, splitting on
-        # \r\n gives the lis of headers strings
-        imap_email_headers = re.sub(
-            r'\r\n ',
-            ' ',
-            re.sub(
-                r'\r\n\r\n$',
-                '',
-                str(
-                    in_imap_email_infos[1],
-                    'utf-8',
-                )
-            )
-        ).split('\r\n')
-    return ret
+        items = "FLAGS INTERNALDATE RFC822.SIZE"
+    extra_items = ""
+    if gmail_mode:
+        extra_items += " X-GM-MSGID X-GM-LABELS"
+    if detailed_infos:
+        # Only the reported headers, kept raw (see MessagesStore.headers)
+        extra_items += f" BODY.PEEK[HEADER.FIELDS ({detailed_header_fields})]"
+    if not extra_items and fetch_dates:
+        return "FAST"
+    return f"({items}{extra_items})"
 
 
-def folder_size(
+def fetch_folder_messages(
     cnx: imaplib.IMAP4_SSL,
-    folder_entry: bytes,
-    returned_folder_attributes: dict[str, str | int],
+    mbx: str,
+    uidset: str,
+    messages: dict[int, tuple[int, tuple[int, int], tuple[str, ...]]],
     progress: FolderProgress = None,
         ) -> Exception | None:
-    fs = 0
-    nb = '0'
-    # folder_entry.decode().split(' "/" ')
-    # 2 element tuple
-    imap_folder_match = imap_folder_re.match(str(folder_entry, 'utf-8'))
-    if not imap_folder_match:
+    try:
+        for batch in fetch_messages_batches(
+                cnx, mbx, uidset, messages_fetch_items()):
+            with imap_stats.timed('parse', mbx):
+                store_fetched_messages(batch, messages)
+            if progress:
+                progress.update_task(advance=len(batch))
+    except Exception as e:
+        return e
+    return None
+
+
+def fetch_folder_changes(
+    cnx: imaplib.IMAP4_SSL,
+    mbx: str,
+    cached_state: dict,
+    folder_state: dict,
+    nmessages: int,
+    messages: dict[int, tuple[int, tuple[int, int], tuple[str, ...]]],
+        ) -> Exception | None:
+    cached_uidnext = cached_state['uidnext']
+    for uid, msg_size, msg_date, msg_flags in zip(
+            cached_state['uids'],
+            cached_state['sizes'],
+            cached_state['dates'],
+            cached_state['flags']):
+        messages[uid] = (
+            msg_size,
+            tuple(msg_date) if msg_date else None,
+            tuple(msg_flags))
+    # Nothing appended nor expunged and, when CONDSTORE is available,
+    # no flag changed: the folder can be skipped altogether
+    if cached_uidnext == folder_state['uidnext'] and \
+            len(messages) == nmessages and \
+            folder_state['highestmodseq'] and \
+            folder_state['highestmodseq'] == cached_state['highestmodseq']:
+        return None
+    # Only retrieve messages appended since previous scan
+    if cached_uidnext != folder_state['uidnext']:
+        ex = fetch_folder_messages(cnx, mbx, f"{cached_uidnext}:*", messages)
+        if ex:
+            return ex
+    # Flags of already known messages, only the changed ones with CONDSTORE
+    if cached_uidnext > 1:
+        uidset = f"1:{cached_uidnext - 1}"
+        try:
+            if folder_state['highestmodseq'] and \
+                    cached_state['highestmodseq']:
+                # Only a few messages expected, no need for batches
+                batches = [fetch_messages_batch(
+                    cnx, mbx, uidset,
+                    "(UID FLAGS) " +
+                    f"(CHANGEDSINCE {cached_state['highestmodseq']})")]
+            else:
+                batches = fetch_messages_batches(
+                    cnx, mbx, uidset, "(UID FLAGS)")
+            for batch in batches:
+                for msg in batch:
+                    if msg.uid in messages and msg.flags is not None:
+                        messages[msg.uid] = messages[msg.uid][:2] + \
+                            (msg.flags,) + messages[msg.uid][3:]
+        except Exception as e:
+            return e
+    # Some messages were expunged since previous scan
+    if len(messages) != nmessages:
+        result, uids = cnx.uid('SEARCH', 'ALL')
+        if result != 'OK':
+            return Exception(f"{mbx} IMAP folder search returned {result} " +
+                             "(fetch_folder_changes)")
+        remaining_uids = set(int(x) for x in uids[0].split())
+        for uid in set(messages).difference(remaining_uids):
+            del messages[uid]
+    return None
+
+
+def imap_response_lines(
+    response: list[bytes | tuple[bytes, bytes]],
+        ) -> list[bytes]:
+    # Rebuild the logical lines of an imaplib untagged response: string
+    # literals become quoted strings in place of their {n} marker. The
+    # element following a (line, literal) tuple is always the rest of
+    # the line
+    lines = []
+    line = None
+    for part in response:
+        if isinstance(part, tuple):
+            if line is None:
+                line = b''
+            literal = imap_literal_re.search(part[0])
+            line += part[0][:literal.start() if literal else None] + \
+                imap_quote(str(part[1], 'utf-8')).encode()
+        elif line is not None:
+            lines.append(line + (part or b''))
+            line = None
+        elif part:
+            lines.append(part)
+    if line is not None:
+        lines.append(line)
+    return lines
+
+
+def parse_imap_astring(data: bytes) -> tuple[str | None, bytes]:
+    # Decode a quoted string, NIL or atom, also returning what follows
+    quoted = imap_quoted_re.match(data)
+    if quoted:
+        value = re.sub(rb'\\(.)', rb'\1', quoted[1])
+        rest = data[quoted.end():]
+    else:
+        value, _, rest = data.partition(b' ')
+        if value.upper() == b'NIL':
+            value = None
+    if value is not None:
+        value = str(value, 'utf-8')
+    return value, rest.lstrip()
+
+
+def mailbox_real_name(mbx: str) -> str:
+    # Decoded name of a quoted IMAP folder name
+    return folder_real_name(parse_imap_astring(mbx.encode())[0])
+
+
+def parse_list_response(
+    entry: bytes,
+        ) -> tuple[tuple[str, ...], str | None, str] | None:
+    # (\HasNoChildren \Sent) "/" "Sent Messages" -> flags, delimiter, name
+    imap_list_match = imap_list_re.match(entry)
+    if not imap_list_match:
+        return None
+    name, _ = parse_imap_astring(imap_list_match['name'])
+    if name is None:
+        return None
+    return (
+        tuple(str(imap_list_match['flags'], 'utf-8').split()),
+        parse_imap_astring(imap_list_match['delimiter'])[0],
+        name,
+        )
+
+
+def parse_status_responses(
+    response: list[bytes | tuple[bytes, bytes]],
+        ) -> dict[str, dict[str, int]]:
+    # "INBOX" (MESSAGES 231 UNSEEN 3 SIZE 1234) indexed by quoted name
+    folders_status = {}
+    for line in imap_response_lines(response):
+        name, attributes = parse_imap_astring(line)
+        if name is None:
+            continue
+        items = str(attributes, 'utf-8').strip('()').split()
+        folders_status[imap_quote(name)] = {
+            item.upper(): int(value)
+            for item, value in zip(items[::2], items[1::2])}
+    return folders_status
+
+
+def folder_mailbox(
+    folder_entry: bytes,
+        ) -> tuple[str, str] | Exception:
+    imap_folder = parse_list_response(folder_entry)
+    if not imap_folder:
         return Exception(f"IMAP folder {folder_entry} does not match " +
-                         "regexp (folder_size)")
-    folder_items = imap_folder_match.group(1).split()
-    # TODO: use other regexp and split on DELIMITER from regexp
-    # str(folder_entry, 'utf-8').split(' "/" ') same as
-    # folder_entry.decode().split(' "/" ')
-    folder_flags = eval(','.join(
-        folder_entry.decode().split(
-            ' "/" ')[0].replace(
-                '\\', '').split(
-                    ' ')).replace(
-                        '(', '("').replace(
-                            ',', '","').replace(
-                                ')', '",)'))
-    s1 = set(folder_flags)
+                         "regexp (folder_mailbox)")
+    s1 = set(flag.lstrip('\\') for flag in imap_folder[0])
     special_folder = s1.intersection(special_folder_flags)
+    # Gmail mode scans All Mail instead of the labels folders
+    if gmail_mode:
+        special_folder.discard('All')
     # Folder name only
-    mbx = '"' + ' '.join(map(lambda x: x.strip('"'), folder_items[1:])) + '"'
-    rmbx = folder_real_name(mbx.strip('"'))
+    mbx = imap_quote(imap_folder[2])
+    rmbx = folder_real_name(imap_folder[2])
     # Folder is not selectable or is tagged with special meaning
     if len(special_folder) > 0:
         return Exception(f"{mbx} IMAP folder not processed {special_folder} " +
-                         "(folder_size)")
+                         "(folder_mailbox)")
     unknown_folder_flags = s1.difference(known_folder_flags)
     # TODO: see how to report this better upstream
     if len(unknown_folder_flags) > 0:
         print(f"{mbx} IMAP folder got unknown flag(s) -> " +
-              f"{unknown_folder_flags} (folder_size)")
+              f"{unknown_folder_flags} (folder_mailbox)")
+    return mbx, rmbx
+
+
+def gmail_labels_usage(
+    labels: list[tuple[str, ...]],
+    sizes: np.ndarray,
+    unread: np.ndarray,
+        ) -> dict[str, list[int]]:
+    # Messages count, unread count and size of each label ('' for messages
+    # without any), messages being first grouped by distinct labels sets
+    labels_sets = {}
+    labels_sets_ids = np.fromiter(
+        (labels_sets.setdefault(msg_labels, len(labels_sets))
+         for msg_labels in labels),
+        np.int64, len(labels))
+    usage = {}
+    for labels_set, count, unread_count, size in zip(
+            labels_sets,
+            np.bincount(labels_sets_ids, minlength=len(labels_sets)).tolist(),
+            np.bincount(labels_sets_ids[unread],
+                        minlength=len(labels_sets)).tolist(),
+            np.bincount(labels_sets_ids, weights=sizes,
+                        minlength=len(labels_sets)).tolist()):
+        for label in labels_set or ('',):
+            label_usage = usage.setdefault(label, [0, 0, 0])
+            label_usage[0] += count
+            label_usage[1] += unread_count
+            label_usage[2] += int(size)
+    return usage
+
+
+def gmail_folders(folders: list[bytes]) -> list[bytes]:
+    # All Mail holds every message once whatever its labels, only the
+    # Trash and Spam ones being elsewhere
+    scanned_folders = []
+    all_mail = False
+    for folder_entry in folders:
+        imap_folder = parse_list_response(folder_entry)
+        if not imap_folder:
+            continue
+        flags = set(flag.lower() for flag in imap_folder[0])
+        all_mail |= '\\all' in flags
+        if flags & {'\\all', '\\trash', '\\junk'}:
+            scanned_folders.append(folder_entry)
+    if not all_mail:
+        raise Exception("IMAP_GMAIL: no \\All (All Mail) folder found")
+    return scanned_folders
+
+
+# Gmail system labels of the special-use folders, All Mail standing for
+# the messages without labels
+gmail_special_use_labels = {
+    '\\all': '',
+    '\\sent': '\\Sent',
+    '\\drafts': '\\Draft',
+    '\\flagged': '\\Starred',
+    '\\important': '\\Important',
+    '\\trash': '\\Trash',
+    '\\junk': '\\Spam',
+    }
+
+
+def gmail_labels_names(folders: list[bytes]) -> dict[str, str]:
+    # Folder names of the labels: user labels are the mailbox names, the
+    # system ones map to INBOX and to the special-use folders
+    labels_names = {'\\Inbox': 'INBOX'}
+    for folder_entry in folders:
+        imap_folder = parse_list_response(folder_entry)
+        if not imap_folder:
+            continue
+        flags, _, name = imap_folder
+        for flag in flags:
+            if flag.lower() in gmail_special_use_labels:
+                labels_names[gmail_special_use_labels[flag.lower()]] = \
+                    folder_real_name(name)
+        labels_names.setdefault(name, folder_real_name(name))
+    return labels_names
+
+
+def folder_messages_attributes(
+    mbx: str,
+    rmbx: str,
+    nmessages: int,
+    messages: dict[int, tuple[int, tuple[int, int], tuple[str, ...]]],
+    returned_folder_attributes: dict[str, str | int],
+        ) -> None:
+    # TODO: see how to report this better upstream
+    if len(messages) != nmessages:
+        print(f"{mbx} IMAP folder got weird sizes -> " +
+              f"{len(messages)} != {nmessages} (folder_size)")
+    uids = sorted(messages)
+    values = [messages[uid] for uid in uids]
+    messages_infos = MessagesStore()
+    sizes = np.fromiter((value[0] for value in values), np.int64, len(uids))
+    dates = np.fromiter(
+        (value[1][0] if value[1] else internaldate_nat for value in values),
+        np.int64, len(uids)).view('datetime64[s]')
+    tzoffsets = np.fromiter(
+        (value[1][1] if value[1] else 0 for value in values),
+        np.int16, len(uids))
+    flags = np.fromiter(
+        (messages_infos.flags_mask(value[2]) for value in values),
+        np.uint64, len(uids))
+    headers = None
+    if detailed_infos:
+        headers = [value[3] if len(value) > 3 else None for value in values]
+    messages_infos.append(
+        mbx, uids, sizes, dates, tzoffsets, flags, headers)
+    messages_summary = MessagesSummary()
+    messages_summary.add(sizes, dates, tzoffsets)
+    biggest_messages = BiggestMessages(biggest_count)
+    biggest_messages.add_folder(messages_infos)
+    if gmail_mode:
+        gmail_values = [
+            value[4:6] if len(value) > 5 else (0, ()) for value in values]
+        returned_folder_attributes.update({
+            'gm_msgids': np.fromiter(
+                (value[0] for value in gmail_values), np.uint64, len(uids)),
+            'labels': gmail_labels_usage(
+                [value[1] for value in gmail_values], sizes,
+                messages_infos.unread()),
+            })
+    returned_folder_attributes.update({
+        'mailbox': mbx,
+        'name': rmbx,
+        'messages': nmessages,
+        'unread': int(messages_infos.unread().sum()),
+        'size': int(sizes.sum()),
+        # Missing or undecodable INTERNALDATE, reported all together
+        'invalid_dates': int(np.isnat(dates).sum()),
+        'infos': messages_infos,
+        'summary': messages_summary,
+        'biggest': biggest_messages,
+        })
+
+
+def folder_size(
+    cnx: imaplib.IMAP4_SSL,
+    folder_entry: bytes,
+    returned_folder_attributes: dict[str, str | int],
+    progress: FolderProgress = None,
+    folders_state: dict[str, dict] = None,
+        ) -> Exception | None:
+    if isinstance(cnx, LocalMailSource):
+        return cnx.folder_size(
+            folder_entry, returned_folder_attributes, progress)
+    nb = '0'
+    mailbox = folder_mailbox(folder_entry)
+    if isinstance(mailbox, Exception):
+        return mailbox
+    mbx, rmbx = mailbox
     # Select the desired folder
     result, nb = cnx.select(mbx, readonly=1)
     if result != 'OK':
@@ -229,106 +1754,743 @@ def folder_size(
     # flags = cnx.response('FLAGS')
     # RECENT response element does not seem to be supported (anymore?)
     # recents = cnx.response('RECENT')
-    unread_emails = 0
-    # No need to further call IMAP server API
-    if int(nb[0]) == 0:
-        returned_folder_attributes.update({
-            'name': rmbx,
-            'messages': 0,
-            'unread': 0,
-            'size': 0,
-            })
-        return None
-    if progress:
+    nmessages = int(nb[0])
+    folder_state = {
+        'mailbox': mbx,
+        'uidvalidity': select_response_code(cnx, 'UIDVALIDITY'),
+        'uidnext': select_response_code(cnx, 'UIDNEXT'),
+        # Only returned when CONDSTORE has been enabled (see login)
+        'highestmodseq': select_response_code(cnx, 'HIGHESTMODSEQ'),
+        }
+    cached_state = None
+    if folders_state and folder_state['uidvalidity'] and \
+            folder_state['uidnext']:
+        cached_state = folders_state.get(mbx)
+        # UIDs of previous scan are meaningless if UIDVALIDITY changed
+        if cached_state and \
+                cached_state['uidvalidity'] != folder_state['uidvalidity']:
+            cached_state = None
+    if progress and nmessages > 0:
         progress.update_task(
-            description="[cyan]Scanning %s (%d)..." % (rmbx, int(nb[0])),
-            total=int(nb[0]),
+            description="[cyan]Scanning %s (%d)..." % (rmbx, nmessages),
+            total=nmessages,
             completed=0,
             visible=True,
             )
-    # and/or verify that int(nb[0]) == len(msg[0].split())
-    # Go through all the messages in the selected folder
-    typ, msgs = cnx.search(None, 'ALL')
-    if typ != 'OK':
-        return Exception(f"{mbx} IMAP folder search returned bad status " +
-                         f"{typ} (and {msgs}) (folder_size)")
-    m = [int(x) for x in msgs[0].split()]
-    if not m:
-        return Exception(f"{mbx} IMAP folder search returned empty list " +
-                         f"{msgs} (folder_size)")
-    # Find the first and last messages
-    # requires the list of IDs to be sorted
-    m.sort()
-    msgset = f"{m[0]}:{m[-1]}"
-    # Add FLAGS to previously returned messages attributes
-    # Same as FAST. See https://www.rfc-editor.org/rfc/rfc3501#section-6.4.5
-    # DO NOT USE RFC822.HEADER which is untagged + INTERNALDATE not returned either
-    if detailed_infos:
-        result, msizes = cnx.fetch(msgset, "(FLAGS INTERNALDATE RFC822.SIZE BODY.PEEK[HEADER])")
-    else:
-        result, msizes = cnx.fetch(msgset, "FAST")
-    # TODO: potentially add further email message details
-    # result, msizes = cnx.fetch(msgset, "(FLAGS INTERNALDATE RFC822.SIZE
-    # BODY.PEEK[HEADER.FIELDS (
-    #   From To Cc Bcc Subject Date Message-ID Priority
-    #   X-Priority References Newsgroups In-Reply-To Content-Type Reply-To)])")
-    if result != 'OK':
-        return Exception(f"IMAP messages sizes returned {result} " +
-                         "(folder_size)")
-    msizes = list(filter(lambda x: x != b')', msizes))
-    # TODO: see how to report this better upstream
-    if len(msizes) != int(nb[0]):
-        print(f"{mbx} IMAP folder got weird sizes -> " +
-              f"{len(msizes)} != {int(nb[0])} (folder_size)")
-    messages_infos = []
-    for msg in map(
-        parse_message_basic_attributes,
-        msizes
-    ):
-        if progress:
-            progress.update_task(advance=1)
-        if len(msg) == 0:
-            continue
-        msg_size = int(msg['SIZE'])
-        msg_date = None
-        try:
-            msg_date = datetime.strptime(
-                msg['DATE'],
-                '%d-%b-%Y %H:%M:%S %z'
-                )
-        except ValueError as e:
-            # TODO: see hoe to report this better upstream
-            print(f"IMAP message date decoding error: {msg[1]} " +
-                  f"{e} (folder_size)")
-        messages_infos.append(
-            {
-                'id': msg.get('ID', 0),
-                'size': msg_size,
-                'date': msg_date,
-                'flags': msg.get('FLAGS', '').split(),
-                'folder': mbx,
-            })
-        if 'Seen' not in msg.get('FLAGS', ''):
-            unread_emails += 1
-        fs += msg_size
+    # Messages (size, date, flags) indexed by UID
+    messages = {}
+    # No need to further call IMAP server API for empty folders
+    if nmessages > 0:
+        if cached_state:
+            ex = fetch_folder_changes(
+                cnx, mbx, cached_state, folder_state, nmessages, messages)
+            if progress:
+                progress.update_task(completed=nmessages)
+        else:
+            ex = fetch_folder_messages(cnx, mbx, "1:*", messages, progress)
+        if ex:
+            return ex
+    with imap_stats.timed('parse', mbx):
+        folder_messages_attributes(
+            mbx, rmbx, nmessages, messages, returned_folder_attributes)
+    returned_folder_attributes['uidvalidity'] = folder_state['uidvalidity']
 #    if progress:
 #        progress.update_task(visible=False)
-    returned_folder_attributes.update({
-        'name': rmbx,
-        'messages': int(nb[0]),
-        'unread': unread_emails,
-        'size': fs,
-        'infos': messages_infos,
-        })
+    if folders_state is not None:
+        uids = sorted(messages)
+        folder_state.update({
+            'uids': uids,
+            'sizes': [messages[uid][0] for uid in uids],
+            'dates': [messages[uid][1] for uid in uids],
+            'flags': [messages[uid][2] for uid in uids],
+            })
+        returned_folder_attributes['state'] = folder_state
     return None
 
 
+# Offline sources: mbox files (Gmail Takeout exports among others) and
+# Maildir folders. The From_ line date of an mbox message stands for its
+# INTERNALDATE and its Status, X-Status and X-Gmail-Labels headers for
+# its flags. Sizes are the on-disk ones
+mbox_from_date_re = re.compile(
+    rb' (?P<month>[A-Za-z]{3}) +(?P<day>\d{1,2}) '
+    rb'(?P<time>\d{1,2}:\d{2}:\d{2})(?: (?P<zone>[+-]\d{4}|[A-Z]{3,4}))? '
+    rb'(?P<year>\d{4})\s*$')
+mbox_flags_headers_re = re.compile(
+    rb'^(Status|X-Status|X-Gmail-Labels):[ \t]*'
+    rb'([^\r\n]*(?:\r?\n[ \t][^\r\n]*)*)',
+    re.IGNORECASE | re.MULTILINE)
+mbox_x_status_flags = (
+    (b'A', '\\Answered'),
+    (b'F', '\\Flagged'),
+    (b'T', '\\Draft'),
+    (b'D', '\\Deleted'),
+    )
+maildir_flags = {
+    'S': '\\Seen',
+    'R': '\\Answered',
+    'F': '\\Flagged',
+    'T': '\\Deleted',
+    'D': '\\Draft',
+    }
+maildir_size_re = re.compile(r',S=(\d+)')
+
+
+def header_fields_re(fields: str) -> re.Pattern:
+    # Header lines (continuation lines included) kept by a
+    # BODY.PEEK[HEADER.FIELDS (fields)] FETCH
+    return re.compile(
+        rb'^(?:' + b'|'.join(
+            re.escape(field.encode()) for field in fields.split()) +
+        rb'):[^\r\n]*(?:\r?\n[ \t][^\r\n]*)*(?:\r?\n|$)',
+        re.IGNORECASE | re.MULTILINE)
+
+
+def mbox_messages(
+    path: str,
+        ) -> Iterator[tuple[int, int, int, bytes, bytes]]:
+    # (headers start, headers end, size, From_ line, raw headers) of each
+    # message of an mbox file. Messages boundaries and header blocks are
+    # searched in a memory map of the file, bodies are never copied
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end_of_file = len(mm)
+            start = 0 if mm[:5] == b'From ' else mm.find(b'\nFrom ') + 1
+            if mm[start:start + 5] != b'From ':
+                return
+            while True:
+                line_end = mm.find(b'\n', start)
+                if line_end < 0:
+                    break
+                next_from = mm.find(b'\nFrom ', line_end)
+                end = next_from if next_from >= 0 else end_of_file
+                # The separating empty line is not part of the last message
+                # either
+                if next_from < 0 and mm[end - 2:end] == b'\n\n':
+                    end -= 1
+                # Empty line ending the headers, CRLF ones being searched
+                # up to the LF one only
+                headers_lf_end = mm.find(b'\n\n', line_end, end)
+                headers_crlf_end = mm.find(
+                    b'\n\r\n', line_end,
+                    end if headers_lf_end < 0 else headers_lf_end)
+                if headers_crlf_end >= 0:
+                    headers_end = headers_crlf_end + 1
+                elif headers_lf_end >= 0:
+                    headers_end = headers_lf_end + 1
+                else:
+                    headers_end = end
+                yield (line_end + 1, headers_end, end - line_end - 1,
+                       mm[start:line_end], mm[line_end + 1:headers_end])
+                if next_from < 0:
+                    break
+                start = next_from + 1
+
+
+def mbox_internaldate(from_line: bytes) -> bytes | None:
+    # Thu Oct 17 01:56:00 2024 (or Sat Oct 05 12:34:56 +0000 2024) of the
+    # From_ line as an INTERNALDATE string, UTC when no numeric offset
+    match = mbox_from_date_re.search(from_line)
+    if not match:
+        return None
+    zone = match['zone'] if match['zone'] and match['zone'][0] in b'+-' \
+        else b'+0000'
+    return b'%2d-%s-%s %s %s' % (
+        int(match['day']), match['month'], match['year'],
+        match['time'].zfill(8), zone)
+
+
+def mbox_message_flags(headers: bytes) -> tuple[str, ...]:
+    flags = []
+    seen = False
+    for name, value in mbox_flags_headers_re.findall(headers):
+        name = name.lower()
+        if name == b'status':
+            seen |= b'R' in value
+        elif name == b'x-status':
+            flags.extend(
+                flag for letter, flag in mbox_x_status_flags
+                if letter in value)
+        else:
+            labels = [label.strip() for label in value.split(b',')]
+            seen |= b'Unread' not in labels
+            if b'Starred' in labels:
+                flags.append('\\Flagged')
+    if seen:
+        flags.insert(0, '\\Seen')
+    return tuple(flags)
+
+
+def maildir_messages(
+    path: str,
+        ) -> list[tuple[str, int, int, tuple[str, ...]]]:
+    # (file path, size, delivery time, flags) of each message of a Maildir
+    # folder from its new and cur directories listing: the size comes from
+    # the S= field of the file name and the date from its leading delivery
+    # time, files being only stat()ed when those are missing
+    messages = []
+    for subdir in ('new', 'cur'):
+        with os.scandir(os.path.join(path, subdir)) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                base, _, info = entry.name.partition(':2,')
+                size = maildir_size_re.search(base)
+                delivery_time = base.partition('.')[0]
+                if not size or not delivery_time.isdigit():
+                    stat = entry.stat()
+                size = int(size[1]) if size else stat.st_size
+                delivery_time = int(delivery_time) \
+                    if delivery_time.isdigit() else int(stat.st_mtime)
+                flags = tuple(
+                    maildir_flags[letter] for letter in info
+                    if letter in maildir_flags) if subdir == 'cur' \
+                    else ('\\Recent',)
+                messages.append((entry.path, size, delivery_time, flags))
+    messages.sort()
+    return messages
+
+
+def local_folders(
+    path: str,
+        ) -> list[tuple[str, str, str]]:
+    # (folder name, 'mbox' or 'maildir', path) of an mbox file, a Maildir
+    # (its Maildir++ .Sub.Folder subfolders included) or a directory tree
+    # of those, sorted by name
+    if os.path.isfile(path):
+        return [(os.path.splitext(os.path.basename(path))[0], 'mbox', path)]
+    folders = []
+    # Maildir paths: folder names
+    maildirs = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        relpath = os.path.relpath(dirpath, path)
+        if os.path.isdir(os.path.join(dirpath, 'cur')) and \
+                os.path.isdir(os.path.join(dirpath, 'new')):
+            parent = os.path.dirname(dirpath)
+            if relpath == '.':
+                name = 'INBOX'
+            elif parent in maildirs and \
+                    os.path.basename(dirpath).startswith('.'):
+                # Maildir++ subfolder, at the top level of the root one
+                name = os.path.basename(dirpath)[1:].replace('.', '/')
+                if parent != path:
+                    name = f"{maildirs[parent]}/{name}"
+            else:
+                name = relpath.replace(os.sep, '/')
+            maildirs[dirpath] = name
+            folders.append((name, 'maildir', dirpath))
+            dirnames[:] = [
+                dirname for dirname in dirnames
+                if dirname not in ('cur', 'new', 'tmp')]
+            continue
+        for filename in sorted(filenames):
+            file_path = os.path.join(dirpath, filename)
+            with open(file_path, 'rb') as f:
+                if f.read(5) != b'From ':
+                    continue
+            folders.append((
+                os.path.splitext(os.path.normpath(
+                    os.path.join(relpath, filename)))[0].replace(os.sep, '/'),
+                'mbox', file_path))
+    return sorted(folders)
+
+
+class LocalMailSource:
+    # Offline archive standing for the IMAP connection: its folders are
+    # listed as LIST responses and scanned into the same records as
+    # folder_size, the UID of a message being its position in its folder
+    # (mbox order, Maildir file names order)
+    def __init__(self, path: str):
+        # Quoted IMAP name: ('mbox' or 'maildir', path)
+        self.folders = {
+            imap_quote(imapclient.imap_utf7.encode(name).decode()):
+            (kind, folder_path)
+            for name, kind, folder_path in local_folders(path)}
+        # Maildir listings of quotas(), reused by the scan
+        self._maildir_listings = {}
+        # Headers offsets (mbox) or files (Maildir) by UID - 1, for the
+        # biggest messages headers
+        self._messages = {}
+
+    def list_folders(self) -> list[bytes]:
+        return [b'(\\HasNoChildren) "/" ' + mbx.encode()
+                for mbx in self.folders]
+
+    def _maildir_messages(
+        self,
+        mbx: str,
+            ) -> list[tuple[str, int, int, tuple[str, ...]]]:
+        if mbx not in self._maildir_listings:
+            self._maildir_listings[mbx] = maildir_messages(
+                self.folders[mbx][1])
+        return self._maildir_listings[mbx]
+
+    def quotas(self) -> tuple[int, None]:
+        # Used storage of the archive in KB, as a QUOTA STORAGE resource,
+        # without limit
+        size = 0
+        for mbx, (kind, path) in self.folders.items():
+            if kind == 'mbox':
+                size += os.path.getsize(path)
+            else:
+                size += sum(msg[1] for msg in self._maildir_messages(mbx))
+        return (size + 1023) // 1024, None
+
+    def folder_size(
+        self,
+        folder_entry: bytes,
+        returned_folder_attributes: dict[str, str | int],
+        progress: FolderProgress = None,
+            ) -> Exception | None:
+        mailbox = folder_mailbox(folder_entry)
+        if isinstance(mailbox, Exception):
+            return mailbox
+        mbx, rmbx = mailbox
+        kind, path = self.folders[mbx]
+        messages = {}
+        try:
+            with imap_stats.timed('read', mbx):
+                if kind == 'mbox':
+                    self._scan_mbox(mbx, rmbx, path, messages, progress)
+                    changed = os.path.getmtime(path)
+                else:
+                    self._scan_maildir(mbx, rmbx, messages, progress)
+                    changed = max(
+                        os.path.getmtime(os.path.join(path, subdir))
+                        for subdir in ('new', 'cur'))
+            # UIDs are positions: a changed folder has new ones
+            uidvalidity = int(changed) & 0xffffffff
+        except OSError as e:
+            return Exception(f"{mbx} local folder {path}: {e} " +
+                             "(LocalMailSource)")
+        with imap_stats.timed('parse', mbx):
+            folder_messages_attributes(
+                mbx, rmbx, len(messages), messages,
+                returned_folder_attributes)
+        returned_folder_attributes['uidvalidity'] = uidvalidity
+        return None
+
+    def _scan_mbox(
+        self,
+        mbx: str,
+        rmbx: str,
+        path: str,
+        messages: dict[int, tuple[int, tuple[int, int], tuple[str, ...]]],
+        progress: FolderProgress = None,
+            ) -> None:
+        # Progress in bytes, the number of messages being unknown
+        if progress:
+            progress.update_task(
+                description=f"[cyan]Scanning {rmbx}...",
+                total=os.path.getsize(path), completed=0, visible=True)
+        fields_re = header_fields_re(detailed_header_fields) \
+            if detailed_infos else None
+        headers_offsets = []
+        sizes = []
+        internaldates = []
+        flags = []
+        headers = []
+        for headers_start, headers_end, size, from_line, msg_headers in \
+                mbox_messages(path):
+            headers_offsets.append((headers_start, headers_end))
+            sizes.append(size)
+            internaldates.append(mbox_internaldate(from_line))
+            flags.append(mbox_message_flags(msg_headers))
+            if fields_re:
+                headers.append(b''.join(fields_re.findall(msg_headers)))
+            if progress and len(sizes) % fetch_batch_size == 0:
+                progress.update_task(completed=headers_end)
+        if progress:
+            progress.update_task(completed=os.path.getsize(path))
+        dates, tzoffsets = decode_internaldates(internaldates)
+        for uid, (size, msg_date, msg_tzoffset, msg_flags) in enumerate(zip(
+                sizes, dates.view(np.int64).tolist(), tzoffsets.tolist(),
+                flags), 1):
+            value = (
+                size,
+                None if msg_date == internaldate_nat
+                else (msg_date, msg_tzoffset),
+                msg_flags)
+            messages[uid] = value + (headers[uid - 1],) if headers \
+                else value
+        self._messages[mbx] = headers_offsets
+
+    def _scan_maildir(
+        self,
+        mbx: str,
+        rmbx: str,
+        messages: dict[int, tuple[int, tuple[int, int], tuple[str, ...]]],
+        progress: FolderProgress = None,
+            ) -> None:
+        maildir_listing = self._maildir_messages(mbx)
+        self._maildir_listings.pop(mbx)
+        if progress:
+            progress.update_task(
+                description="[cyan]Scanning %s (%d)..." % (
+                    rmbx, len(maildir_listing)),
+                total=len(maildir_listing), completed=len(maildir_listing),
+                visible=True)
+        fields_re = header_fields_re(detailed_header_fields) \
+            if detailed_infos else None
+        for uid, (path, size, delivery_time, msg_flags) in enumerate(
+                maildir_listing, 1):
+            value = (size, (delivery_time, 0), msg_flags)
+            # Only the detailed mode opens the messages files
+            messages[uid] = value + (b''.join(fields_re.findall(
+                maildir_message_headers(path))),) if fields_re else value
+        self._messages[mbx] = [msg[0] for msg in maildir_listing]
+
+    def _messages_locations(self, mbx: str) -> list:
+        # Listed again for the folders not scanned by this run (read back
+        # from a resumed export)
+        if mbx not in self._messages:
+            kind, path = self.folders[mbx]
+            if kind == 'mbox':
+                self._messages[mbx] = [
+                    (headers_start, headers_end)
+                    for headers_start, headers_end, *_ in mbox_messages(path)]
+            else:
+                self._messages[mbx] = [
+                    msg[0] for msg in self._maildir_messages(mbx)]
+                self._maildir_listings.pop(mbx)
+        return self._messages[mbx]
+
+    def fetch_headers(
+        self,
+        mbx: str,
+        msg_ids: list[int],
+            ) -> dict[int, bytes]:
+        # Same headers as fetch_messages_headers
+        fields_re = header_fields_re("FROM TO SUBJECT")
+        kind, path = self.folders[mbx]
+        headers = {}
+        try:
+            locations = self._messages_locations(mbx)
+            # Folder changed since its export was resumed
+            msg_ids = sorted(
+                msg_id for msg_id in msg_ids if msg_id <= len(locations))
+            if kind == 'maildir':
+                for msg_id in msg_ids:
+                    headers[msg_id] = b''.join(fields_re.findall(
+                        maildir_message_headers(locations[msg_id - 1])))
+                return headers
+            with open(path, 'rb') as f, mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for msg_id in msg_ids:
+                    headers_start, headers_end = locations[msg_id - 1]
+                    headers[msg_id] = b''.join(fields_re.findall(
+                        mm[headers_start:headers_end]))
+        except OSError as e:
+            print(f"{mbx} local folder {path}: {e} (fetch_headers)")
+        return headers
+
+    def keepalive(self) -> contextlib.nullcontext:
+        return contextlib.nullcontext()
+
+    def logout(self) -> None:
+        self._messages.clear()
+
+
+def maildir_message_headers(path: str) -> bytes:
+    # Header block of a Maildir message file, up to its first empty line
+    headers = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if line in (b'\n', b'\r\n'):
+                break
+            headers.append(line)
+    return b''.join(headers)
+
+
 def env_or_tty_passwd() -> str:
     return os.getenv("LOGPASSWD") or getpass.getpass(
         f"Enter password for user {os.environ['LOGNAME']} > "
         )
 
 
+class InstrumentedImap:
+    # imaplib connection mixin recording every command in imap_stats, the
+    # bytes being counted at the imaplib read/send level
+    bytes_in = 0
+    bytes_out = 0
+
+    def open(self, *args, **kwargs) -> None:
+        # TCP connection and TLS handshake
+        start = time.perf_counter()
+        try:
+            super().open(*args, **kwargs)
+        finally:
+            imap_stats.record_command(
+                'CONNECT', time.perf_counter() - start, 0, 0)
+
+    def read(self, size: int) -> bytes:
+        data = super().read(size)
+        self.bytes_in += len(data)
+        return data
+
+    def readline(self) -> bytes:
+        line = super().readline()
+        self.bytes_in += len(line)
+        return line
+
+    def send(self, data: bytes) -> None:
+        self.bytes_out += len(data)
+        super().send(data)
+
+    def _simple_command(self, name: str, *args) -> tuple[str, list]:
+        start, bytes_in, bytes_out = \
+            time.perf_counter(), self.bytes_in, self.bytes_out
+        try:
+            return super()._simple_command(name, *args)
+        finally:
+            imap_stats.record_command(
+                f"UID {args[0].upper()}" if name == 'UID' and args else name,
+                time.perf_counter() - start,
+                self.bytes_in - bytes_in, self.bytes_out - bytes_out)
+
+
+class ResilientImap:
+    # imaplib connection mixin reconnecting when the connection is dropped
+    # or times out: the connection is opened again (reusing the TLS
+    # session when possible), authenticated, CONDSTORE enabled and the
+    # folder selected again, then the failed command is retried. Only
+    # meant for the read-only commands of the scans, FETCH batches being
+    # retried as a whole (a folder scan goes on from its last fetched batch)
+    credentials = None
+    enabled_capabilities = ()
+    selected = None
+    reconnecting = False
+    tls_session = None
+
+    def login(self, user: str, password: str) -> tuple[str, list]:
+        result = super().login(user, password)
+        self.credentials = (user, password)
+        # Taken while the connection is sane, TLS 1.3 tickets being
+        # received by then. Not resumable once the connection failed
+        self.tls_session = getattr(self.sock, 'session', None)
+        return result
+
+    def enable(self, capability: str) -> tuple[str, list]:
+        result = super().enable(capability)
+        if capability not in self.enabled_capabilities:
+            self.enabled_capabilities += (capability,)
+        return result
+
+    def select(
+        self,
+        mailbox: str = 'INBOX',
+        readonly: bool = False,
+            ) -> tuple[str, list]:
+        result = super().select(mailbox, readonly)
+        # Before being consumed by response('UIDVALIDITY')
+        self.selected = (
+            mailbox, readonly,
+            self.untagged_responses.get('UIDVALIDITY', [None])[-1]) \
+            if result[0] == 'OK' else None
+        return result
+
+    def reconnect(self) -> None:
+        try:
+            self.shutdown()
+        except OSError:
+            pass
+        # Same initial state as a new imaplib connection
+        self.state = 'LOGOUT'
+        self.literal = None
+        self.tagged_commands = {}
+        self.untagged_responses = {}
+        self.continuation_response = ''
+        self.is_readonly = False
+        self.reconnecting = True
+        try:
+            self.open(self.host, self.port, imap_timeout)
+            self._connect()
+            self.login(*self.credentials)
+            if self.enabled_capabilities:
+                # Same as login(), capabilities can change once authenticated
+                self.capabilities = tuple(server_capabilities(self))
+            for capability in self.enabled_capabilities:
+                self.enable(capability)
+            if self.selected:
+                mailbox, readonly, uidvalidity = self.selected
+                result, _ = self.select(mailbox, readonly)
+                if result != 'OK' or self.selected[2] != uidvalidity:
+                    # Fetched UIDs are meaningless in this case
+                    raise imaplib.IMAP4.error(
+                        f"{mailbox} IMAP folder can not be selected again " +
+                        f"({result}, UIDVALIDITY {uidvalidity} -> " +
+                        f"{self.selected and self.selected[2]})")
+        finally:
+            self.reconnecting = False
+
+    def _simple_command(self, name: str, *args) -> tuple[str, list]:
+        for attempt in range(reconnect_attempts + 1):
+            try:
+                if attempt:
+                    time.sleep(min(2 ** (attempt - 1), 60))
+                    self.reconnect()
+                    print(f"WARNING: reconnected to {self.host}" + (
+                        " (TLS session reused)"
+                        if getattr(self.sock, 'session_reused', False)
+                        else ""))
+                return super()._simple_command(name, *args)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                if self.reconnecting or not self.credentials or \
+                        name == 'LOGOUT' or attempt == reconnect_attempts:
+                    raise
+                print(f"WARNING: {self.host} IMAP connection lost " +
+                      f"({e or type(e).__name__}), reconnecting " +
+                      f"({attempt + 1}/{reconnect_attempts})")
+
+    @contextlib.contextmanager
+    def keepalive(self) -> Iterator[None]:
+        # NOOP every keepalive_interval seconds, the connection must not
+        # be used otherwise until the end of the with block
+        stop = threading.Event()
+
+        def send_noop() -> None:
+            while not stop.wait(keepalive_interval):
+                try:
+                    self.noop()
+                except Exception as e:
+                    print(f"WARNING: {self.host} keepalive failed: {e}")
+                    return
+
+        thread = threading.Thread(target=send_noop, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+
+# RFC 4978, unknown to imaplib
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+
+class CompressedImap:
+    # imaplib connection mixin negotiating COMPRESS=DEFLATE once
+    # authenticated (RFC 4978): both directions are then raw deflate
+    # streams, the responses being inflated into a buffer the imaplib
+    # reads are served from. Below InstrumentedImap, which keeps counting
+    # the uncompressed bytes, the wire ones being recorded per command
+    compressor = None
+    decompressor = None
+    inflated = b''
+    # Uncompressed and wire bytes of the compressed stream
+    bytes_inflated = 0
+    wire_bytes_in = 0
+    bytes_deflated = 0
+    wire_bytes_out = 0
+
+    def open(self, *args, **kwargs) -> None:
+        # Uncompressed again on new connections (reconnect)
+        self.compressor = self.decompressor = None
+        self.inflated = b''
+        super().open(*args, **kwargs)
+
+    def login(self, user: str, password: str) -> tuple[str, list]:
+        result = super().login(user, password)
+        if imap_compress:
+            # Mostly advertised once authenticated, often with the LOGIN
+            # completion (or an untagged CAPABILITY) saving a round trip
+            _, untagged = self.response('CAPABILITY')
+            capabilities = response_capabilities(
+                result[1][-1] if result[1] else b'', untagged)
+            self.capabilities = tuple(
+                capabilities if capabilities is not None
+                else server_capabilities(self))
+            if 'COMPRESS=DEFLATE' in self.capabilities:
+                self.compress()
+        return result
+
+    def compress(self) -> None:
+        result, data = self._simple_command('COMPRESS', 'DEFLATE')
+        if result != 'OK':
+            print(f"WARNING: {self.host} COMPRESS DEFLATE returned " +
+                  f"{result} {data}")
+            return
+        # Nothing else is sent by the server before the next command
+        self.compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.inflated = bytearray()
+
+    def inflate(self) -> bool:
+        # False at the end of the connection
+        data = self.file.read1(1 << 16)
+        if not data:
+            return False
+        self.wire_bytes_in += len(data)
+        data = self.decompressor.decompress(data)
+        self.bytes_inflated += len(data)
+        self.inflated += data
+        return True
+
+    def read(self, size: int) -> bytes:
+        if not self.decompressor:
+            return super().read(size)
+        while len(self.inflated) < size and self.inflate():
+            pass
+        data = bytes(self.inflated[:size])
+        del self.inflated[:size]
+        return data
+
+    def readline(self) -> bytes:
+        if not self.decompressor:
+            return super().readline()
+        start = 0
+        while (end := self.inflated.find(b'\n', start)) < 0:
+            start = len(self.inflated)
+            if start > imaplib._MAXLINE:
+                raise self.error(f"got more than {imaplib._MAXLINE} bytes")
+            if not self.inflate():
+                end = start - 1
+                break
+        line = bytes(self.inflated[:end + 1])
+        del self.inflated[:end + 1]
+        return line
+
+    def send(self, data: bytes) -> None:
+        if self.compressor:
+            self.bytes_deflated += len(data)
+            data = self.compressor.compress(data) + \
+                self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.wire_bytes_out += len(data)
+        super().send(data)
+
+    def _simple_command(self, name: str, *args) -> tuple[str, list]:
+        counters = (self.bytes_inflated, self.wire_bytes_in,
+                    self.bytes_deflated, self.wire_bytes_out)
+        try:
+            return super()._simple_command(name, *args)
+        finally:
+            if self.compressor:
+                imap_stats.record_compression(*(
+                    count - previous for count, previous in zip(
+                        (self.bytes_inflated, self.wire_bytes_in,
+                         self.bytes_deflated, self.wire_bytes_out),
+                        counters)))
+
+
+class ImapSession(
+        ResilientImap, InstrumentedImap, CompressedImap, imaplib.IMAP4):
+    pass
+
+
+class ImapSSLSession(
+        ResilientImap, InstrumentedImap, CompressedImap, imaplib.IMAP4_SSL):
+    def _create_socket(self, timeout: float | None) -> ssl.SSLSocket:
+        # Abbreviated TLS handshake when reconnecting
+        sock = imaplib.IMAP4._create_socket(self, timeout)
+        return self.ssl_context.wrap_socket(
+            sock, server_hostname=self.host, session=self.tls_session)
+
+
 def login(
     svr: str,
     port: int = 993,
@@ -336,7 +2498,10 @@ def login(
     password: str = None,
         ) -> imaplib.IMAP4_SSL:
     # Open a connection to the IMAP server using SSL and proper port
-    cnx = imaplib.IMAP4_SSL(svr, port)
+    if imap_ssl:
+        cnx = ImapSSLSession(svr, port, timeout=imap_timeout)
+    else:
+        cnx = ImapSession(svr, port, timeout=imap_timeout)
     try:
         cnx.login(user, password)
     except imaplib.IMAP4.error as e:
@@ -344,9 +2509,301 @@ def login(
         raise imaplib.IMAP4.error(f"IMAP Login error: {e}")
     except Exception as e:
         raise Exception(f"IMAP Login error. Unknown exception: {e}")
+    if folders_state_dir:
+        # Capabilities can change once authenticated (already updated
+        # when looking for COMPRESS=DEFLATE)
+        if not imap_compress:
+            cnx.capabilities = tuple(server_capabilities(cnx))
+        # Get HIGHESTMODSEQ on SELECT for detecting flags changes
+        if 'CONDSTORE' in cnx.capabilities and 'ENABLE' in cnx.capabilities:
+            cnx.enable('CONDSTORE')
     return cnx
 
 
+def response_capabilities(
+    text: bytes | str,
+    untagged: list[bytes | None] = None,
+        ) -> set[str] | None:
+    # Capabilities of a completion [CAPABILITY ...] code or untagged
+    # CAPABILITY responses, None when there is neither
+    if isinstance(text, bytes):
+        text = str(text, 'utf-8', 'replace')
+    code = imap_capability_code_re.search(text)
+    if code:
+        return set(code[1].upper().split())
+    untagged = [data for data in untagged or () if data]
+    if untagged:
+        return set(str(b' '.join(untagged), 'utf-8').upper().split())
+    return None
+
+
+def server_capabilities(
+    cnx: imaplib.IMAP4_SSL,
+        ) -> set[str]:
+    result, capabilities = cnx.capability()
+    if result != 'OK':
+        raise Exception('Unable to retrieve IMAP server capabilities')
+    return set(str(capabilities[0], 'utf-8').upper().split())
+
+
+def folders_state_path(
+    user: str,
+    svr: str,
+        ) -> str:
+    return os.path.join(
+        folders_state_dir,
+        f"{user}@{svr}.json".replace(os.sep, '_'))
+
+
+def load_folders_state(
+    path: str,
+        ) -> dict[str, dict]:
+    # Previous scan state of every folder, indexed by IMAP folder name
+    try:
+        with open(path, encoding='utf-8') as f:
+            folders_state = json.load(f)
+        # Older formats are simply ignored: next scan is a full one
+        if folders_state.get('version') != folders_state_version:
+            return {}
+        return folders_state.get('folders', {})
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"WARNING: ignoring folders state {path}: {e}")
+        return {}
+
+
+def save_folders_state(
+    path: str,
+    folders_state: list[dict],
+        ) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # Write then rename so that an interrupted run keeps the previous state
+    with open(f"{path}.tmp", "w", encoding='utf-8') as f:
+        json.dump({
+            'version': folders_state_version,
+            'folders': {state['mailbox']: state for state in folders_state},
+            }, f)
+    os.replace(f"{path}.tmp", path)
+
+
+# Local index of folders and messages metadata: folders are keyed by
+# account, IMAP name and UIDVALIDITY, messages by folder and UID. Each
+# scan adds the folders snapshots used for the growth reports. Flags are
+# bit masks whose bits are given by the flags table, the system flags
+# having the same bits as in MessagesStore
+messages_index_schema = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    time INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS folders (
+    id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    UNIQUE (account, mailbox, uidvalidity)
+);
+CREATE TABLE IF NOT EXISTS folder_snapshots (
+    scan_id INTEGER NOT NULL REFERENCES scans (id),
+    folder_id INTEGER NOT NULL REFERENCES folders (id),
+    messages INTEGER NOT NULL,
+    unread INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (scan_id, folder_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS flags (
+    bit INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS messages (
+    folder_id INTEGER NOT NULL REFERENCES folders (id),
+    uid INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    date INTEGER,
+    tzoffset INTEGER NOT NULL,
+    flags INTEGER NOT NULL,
+    first_scan_id INTEGER NOT NULL,
+    last_scan_id INTEGER NOT NULL,
+    PRIMARY KEY (folder_id, uid)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS messages_size ON messages (size);
+"""
+
+
+def open_messages_index(
+    path: str,
+        ) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # Waiting for the other batch processes updating the index
+    db = sqlite3.connect(path, timeout=300)
+    db.execute("PRAGMA journal_mode = WAL")
+    with db:
+        db.executescript(messages_index_schema)
+        db.executemany(
+            "INSERT OR IGNORE INTO flags (bit, name) VALUES (?, ?)",
+            enumerate(MessagesStore.system_flags))
+    return db
+
+
+def index_flags_masks(
+    db: sqlite3.Connection,
+    messages: MessagesStore,
+        ) -> np.ndarray:
+    # Renumber the store flags bits to the index ones, as signed 64 bits
+    # integers for SQLite
+    bits = {name: bit for bit, name in db.execute(
+        "SELECT bit, name FROM flags")}
+    flags = np.zeros(len(messages), np.uint64)
+    for bit, flag in enumerate(messages.flag_names):
+        if flag not in bits:
+            if len(bits) == 64:
+                print(f"Too many IMAP flags, ignoring {flag} (index)")
+                continue
+            bits[flag] = len(bits)
+            db.execute("INSERT INTO flags (bit, name) VALUES (?, ?)",
+                       (bits[flag], flag))
+        flags[(messages.flags & np.uint64(1 << bit)) != 0] |= \
+            np.uint64(1 << bits[flag])
+    return flags.view(np.int64)
+
+
+def update_messages_index(
+    db: sqlite3.Connection,
+    account: str,
+    folders: list[bytes],
+    scanned_folders: list[tuple[dict, Exception]],
+        ) -> None:
+    # Single transaction: an interrupted update keeps the previous index
+    with db:
+        scan_id = db.execute(
+            "INSERT INTO scans (account, time) VALUES (?, ?)",
+            (account, int(datetime.now(timezone.utc).timestamp()))).lastrowid
+        for folder_infos, _ in scanned_folders:
+            if 'infos' not in folder_infos or \
+                    not folder_infos.get('uidvalidity'):
+                continue
+            mbx = folder_infos['mailbox']
+            db.execute(
+                "INSERT OR IGNORE INTO folders (account, mailbox, " +
+                "uidvalidity) VALUES (?, ?, ?)",
+                (account, mbx, folder_infos['uidvalidity']))
+            (folder_id,), = db.execute(
+                "SELECT id FROM folders WHERE account = ? AND mailbox = ? " +
+                "AND uidvalidity = ?",
+                (account, mbx, folder_infos['uidvalidity']))
+            # UIDs of another UIDVALIDITY are meaningless
+            db.execute(
+                "DELETE FROM messages WHERE folder_id IN (SELECT id FROM " +
+                "folders WHERE account = ? AND mailbox = ? AND id != ?)",
+                (account, mbx, folder_id))
+            db.execute(
+                "INSERT INTO folder_snapshots VALUES (?, ?, ?, ?, ?)",
+                (scan_id, folder_id, folder_infos['messages'],
+                 folder_infos['unread'], folder_infos['size']))
+            messages = folder_infos['infos']
+            nat = np.datetime64('NaT').astype(np.int64)
+            db.executemany(
+                "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?) " +
+                "ON CONFLICT (folder_id, uid) DO UPDATE SET " +
+                "size = excluded.size, date = excluded.date, " +
+                "tzoffset = excluded.tzoffset, flags = excluded.flags, " +
+                "last_scan_id = excluded.last_scan_id",
+                ((folder_id, msg_id, msg_size,
+                  None if msg_date == nat else msg_date,
+                  msg_tzoffset, msg_flags, scan_id, scan_id)
+                 for msg_id, msg_size, msg_date, msg_tzoffset, msg_flags
+                 in zip(
+                     messages.ids.tolist(),
+                     messages.sizes.tolist(),
+                     messages.dates.astype(np.int64).tolist(),
+                     messages.tzoffsets.tolist(),
+                     index_flags_masks(db, messages).tolist())))
+            # Expunged since previous scan
+            db.execute(
+                "DELETE FROM messages WHERE folder_id = ? AND " +
+                "last_scan_id != ?", (folder_id, scan_id))
+        # Folders deleted on the server
+        listed_folders = [
+            mailbox[0] for mailbox in map(folder_mailbox, folders)
+            if not isinstance(mailbox, Exception)]
+        db.execute(
+            "DELETE FROM messages WHERE folder_id IN (SELECT id FROM " +
+            "folders WHERE account = ? AND mailbox NOT IN (SELECT value " +
+            "FROM json_each(?)))", (account, json.dumps(listed_folders)))
+
+
+def messages_index_report(
+    db: sqlite3.Connection,
+    account: str,
+    report: str,
+        ) -> tuple[list[str], list[list]]:
+    # Report name and optional parameter, e.g. largest:50 or growth:7
+    name, _, parameter = report.partition(':')
+    now = int(datetime.now(timezone.utc).timestamp())
+    flag_names = dict(db.execute("SELECT bit, name FROM flags"))
+    if name == 'largest':
+        rows = []
+        for msg_id, msg_size, msg_date, msg_tzoffset, mbx, msg_flags in \
+                db.execute(
+                    "SELECT uid, size, date, tzoffset, mailbox, flags " +
+                    "FROM messages JOIN folders ON folders.id = folder_id " +
+                    "WHERE account = ? ORDER BY size DESC LIMIT ?",
+                    (account, int(parameter or 20))):
+            rows.append([
+                msg_id,
+                human_readable_size(msg_size),
+                datetime.fromtimestamp(msg_date, timezone(timedelta(
+                    minutes=msg_tzoffset))) if msg_date is not None else '',
+                mailbox_real_name(mbx),
+                ' '.join(flag for bit, flag in flag_names.items()
+                         if msg_flags & (1 << bit))])
+        return ["ID", "Size", "Date", "Folder", "Flags"], rows
+    if name == 'growth':
+        # Latest snapshot of each folder against the latest one taken
+        # before the period, or the oldest one when the index is younger
+        since = now - 86400 * int(parameter or 7)
+        latest = {}
+        previous = {}
+        for mbx, scan_time, nmessages, size in db.execute(
+                "SELECT mailbox, time, messages, size FROM folder_snapshots " +
+                "JOIN scans ON scans.id = scan_id " +
+                "JOIN folders ON folders.id = folder_id " +
+                "WHERE scans.account = ? ORDER BY scan_id", (account,)):
+            if mbx not in previous or scan_time <= since:
+                previous[mbx] = (scan_time, nmessages, size)
+            latest[mbx] = (scan_time, nmessages, size)
+        # Folders deleted since are not part of the latest scan
+        last_scan_time = max(
+            (scan_time for scan_time, _, _ in latest.values()), default=0)
+        rows = [
+            [mailbox_real_name(mbx), nmessages,
+             nmessages - previous[mbx][1],
+             size, size - previous[mbx][2],
+             datetime.fromtimestamp(previous[mbx][0]).strftime(
+                 "%Y-%m-%d %H:%M")]
+            for mbx, (scan_time, nmessages, size) in latest.items()
+            if scan_time == last_scan_time]
+        rows.sort(key=lambda row: row[4], reverse=True)
+        return ["Folder", "# Msg", "+/- Msg", "Size", "+/- Size",
+                "Since"], rows
+    if name == 'old-unread':
+        older_than = now - 86400 * int(parameter or 365)
+        rows = [
+            [mailbox_real_name(mbx), nunread, size,
+             datetime.fromtimestamp(oldest, timezone.utc).date()]
+            for mbx, nunread, size, oldest in db.execute(
+                "SELECT mailbox, COUNT(*), SUM(size), MIN(date) " +
+                "FROM messages JOIN folders ON folders.id = folder_id " +
+                "WHERE account = ? AND flags & 1 = 0 AND date < ? " +
+                "GROUP BY mailbox ORDER BY SUM(size) DESC",
+                (account, older_than))]
+        return ["Folder", "# Unread", "Size", "Oldest"], rows
+    raise ValueError(f"Unknown index report {report} " +
+                     "(largest, growth or old-unread)")
+
+
 def get_quotas(
     cnx: imaplib.IMAP4_SSL,
         ) -> tuple[int, int]:
@@ -376,7 +2833,55 @@ def get_folders(
     result, folders = cnx.list()
     if result != 'OK':
         raise Exception(f"IMAP folder list returned {result}")
-    return folders
+    return imap_response_lines(folders)
+
+
+def folders_overview(
+    cnx: imaplib.IMAP4_SSL,
+        ) -> list[tuple[dict[str, str | int], Exception | None]]:
+    # Folders messages, unread and (if STATUS=SIZE, RFC 8438) size
+    # without any SELECT nor FETCH, all in one round trip with
+    # LIST-STATUS (RFC 5819) or one STATUS per folder otherwise
+    capabilities = server_capabilities(cnx)
+    status_items = ['MESSAGES', 'UNSEEN']
+    if 'STATUS=SIZE' in capabilities:
+        status_items.append('SIZE')
+    status_items = f"({' '.join(status_items)})"
+    folders_status = {}
+    if 'LIST-STATUS' in capabilities:
+        result, data = cnx._simple_command(
+            'LIST', '""', '*', 'RETURN', f"(STATUS {status_items})")
+        result, folders = cnx._untagged_response(result, data, 'LIST')
+        if result != 'OK':
+            raise Exception(f"IMAP folder list status returned {result}")
+        folders = imap_response_lines(folders)
+        folders_status = parse_status_responses(cnx.response('STATUS')[1])
+    else:
+        folders = get_folders(cnx)
+    overview = []
+    for folder in folders:
+        mailbox = folder_mailbox(folder)
+        if isinstance(mailbox, Exception):
+            overview.append(({}, mailbox))
+            continue
+        mbx, rmbx = mailbox
+        if mbx not in folders_status:
+            result, data = cnx.status(mbx, status_items)
+            if result != 'OK':
+                overview.append(({}, Exception(
+                    f"{mbx} IMAP folder status returned {result} " +
+                    "(folders_overview)")))
+                continue
+            folders_status.update(parse_status_responses(data))
+        folder_status = folders_status.get(mbx, {})
+        overview.append(({
+            'name': rmbx,
+            'messages': folder_status.get('MESSAGES', 0),
+            'unread': folder_status.get('UNSEEN', 0),
+            # Unknown without STATUS=SIZE
+            'size': folder_status.get('SIZE'),
+            }, None))
+    return overview
 
 
 def error_or_warning(cond: bool) -> str:
@@ -385,81 +2890,789 @@ def error_or_warning(cond: bool) -> str:
     return "WARNING"
 
 
-# Convert message entry for proper CSV output
-def convert_message_entry(*args) -> list[int | str]:
-    return [
-        [*args][0][0],                                # ID
-        [*args][0][1],                                # SIZE
-        [*args][0][2],                                # DATE
-        ' '.join([*args][0][3]),                      # FLAGS
-        folder_real_name([*args][0][4].strip('"'))    # MAILBOX FOLDER
-    ]
+def scan_folders(
+    cnx: imaplib.IMAP4_SSL,
+    folders: list[bytes],
+    progress: Progress = None,
+    folders_state: dict[str, dict] = None,
+    export: MessagesCsvExport = None,
+        ) -> list[tuple[dict[str, str | int], Exception | None]]:
+    scanned_folders = []
+    sub_progress = None
+    if progress:
+        main_folder_task = progress.add_task(
+            "[yellow]Processing folders...",
+            total=len(folders))
+        sub_progress = FolderProgress(progress)
+        sub_folder_task = progress.add_task(
+            "[cyan]\tScanning XXX...",
+            visible=False,
+        )
+        sub_progress.set_task(sub_folder_task)
+    for folder in folders:
+        if progress:
+            progress.update(main_folder_task, advance=1)
+        folder_infos = dict()
+        ex = folder_size(cnx, folder, folder_infos, sub_progress,
+                         folders_state)
+        if export:
+            export.write_folder(folder_infos)
+        scanned_folders.append((folder_infos, ex))
+    return scanned_folders
+
+
+def scan_folders_parallel(
+    cnx: imaplib.IMAP4_SSL,
+    folders: list[bytes],
+    workers: int,
+    user: str,
+    password: str,
+    progress: Progress = None,
+    folders_state: dict[str, dict] = None,
+    export: MessagesCsvExport = None,
+        ) -> list[tuple[dict[str, str | int], Exception | None]]:
+    # Each worker owns its IMAP connection (the first one reuses the
+    # already opened one) and pulls folders from a shared queue.
+    # Results are stored by folder index to keep the LIST ordering
+    scanned_folders = [
+        ({}, Exception(f"{folder} IMAP folder not scanned " +
+                       "(scan_folders_parallel)"))
+        for folder in folders]
+    pending_folders = queue.Queue()
+    for index, folder in enumerate(folders):
+        pending_folders.put((index, folder))
+    if progress:
+        main_folder_task = progress.add_task(
+            f"[yellow]Processing folders ({workers} workers)...",
+            total=len(folders))
+
+    def worker(worker_id: int) -> None:
+        worker_progress = None
+        if progress:
+            worker_progress = FolderProgress(progress)
+            worker_progress.set_task(progress.add_task(
+                f"[cyan]\tWorker {worker_id} idle...",
+                visible=False,
+            ))
+        worker_cnx = cnx
+        if worker_id > 0:
+            try:
+                worker_cnx = login(imap_server, imap_port, user, password)
+            except Exception as e:
+                print(f"Worker {worker_id} got {e} (scan_folders_parallel)")
+                return
+        try:
+            while True:
+                try:
+                    index, folder = pending_folders.get_nowait()
+                except queue.Empty:
+                    break
+                folder_infos = dict()
+                ex = folder_size(worker_cnx, folder, folder_infos,
+                                 worker_progress, folders_state)
+                if export:
+                    export.write_folder(folder_infos)
+                scanned_folders[index] = (folder_infos, ex)
+                if progress:
+                    progress.update(main_folder_task, advance=1)
+        finally:
+            if worker_id > 0:
+                worker_cnx.logout()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [
+                executor.submit(worker, worker_id)
+                for worker_id in range(workers)]:
+            future.result()
+    return scanned_folders
+
+
+class AsyncImapCommand:
+    def __init__(
+        self,
+        tag: str,
+        callback: Callable[[list[bytes | tuple[bytes, bytes]]], None] = None,
+            ):
+        self.tag = tag
+        self.future = asyncio.get_running_loop().create_future()
+        self.untagged = []
+        self.callback = callback
+        self.error = None
+        # Instrumentation, pipelined commands time including their wait
+        # for the previous ones
+        self.name = None
+        self.start = time.perf_counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.wire_bytes_in = 0
+        self.wire_bytes_out = 0
+
+
+class AsyncImapConnection:
+    # Minimal asyncio IMAP client: commands are written as soon as they
+    # are issued, without waiting for the previous ones to complete
+    # (pipelining). Servers process the commands of a connection in
+    # order, therefore untagged responses belong to the oldest pending one
+    literal_re = re.compile(rb'\{(\d+)\}$')
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+            ):
+        self.reader = reader
+        self.writer = writer
+        self.tag_number = 0
+        self.pending = collections.deque()
+        # Latest [CAPABILITY ...] code of a tagged response
+        self.capabilities = None
+        self.bytes_in = 0
+        self.wire_bytes_in = 0
+        self.closed = False
+        # FETCH responses received, folders scans on a lost connection
+        # having made progress when not 0
+        self.fetched_messages = 0
+        # COMPRESS=DEFLATE streams, responses being inflated in a buffer
+        self.compressor = None
+        self.decompressor = None
+        self.inflated = bytearray()
+        self.reader_task = asyncio.create_task(self._read_responses())
+
+    @classmethod
+    async def open(
+        cls,
+        svr: str,
+        port: int = 993,
+            ) -> 'AsyncImapConnection':
+        start = time.perf_counter()
+        reader, writer = await asyncio.open_connection(
+            svr, port, ssl=ssl.create_default_context() if imap_ssl else None)
+        imap_stats.record_command(
+            'CONNECT', time.perf_counter() - start, 0, 0)
+        greeting = await reader.readline()
+        if not greeting.startswith(b'* OK'):
+            writer.close()
+            raise Exception(f"IMAP server greeting error: {greeting}")
+        return cls(reader, writer)
+
+    async def _inflate(self) -> bool:
+        # False at the end of the connection
+        data = await self.reader.read(1 << 16)
+        if not data:
+            return False
+        self.wire_bytes_in += len(data)
+        self.inflated += self.decompressor.decompress(data)
+        return True
+
+    async def _readline(self) -> bytes:
+        if not self.decompressor:
+            line = await self.reader.readline()
+            self.wire_bytes_in += len(line)
+            return line
+        start = 0
+        while (end := self.inflated.find(b'\n', start)) < 0:
+            start = len(self.inflated)
+            if not await self._inflate():
+                end = start - 1
+                break
+        line = bytes(self.inflated[:end + 1])
+        del self.inflated[:end + 1]
+        return line
+
+    async def _readexactly(self, size: int) -> bytes:
+        if not self.decompressor:
+            data = await self.reader.readexactly(size)
+            self.wire_bytes_in += len(data)
+            return data
+        while len(self.inflated) < size:
+            if not await self._inflate():
+                raise asyncio.IncompleteReadError(
+                    bytes(self.inflated), size)
+        data = bytes(self.inflated[:size])
+        del self.inflated[:size]
+        return data
+
+    async def _read_response(self) -> list[bytes | tuple[bytes, bytes]]:
+        # Same layout as imaplib: (line, literal) tuples then the
+        # remaining of the line
+        parts = []
+        line = await self._readline()
+        if not line:
+            raise ConnectionError("IMAP connection closed")
+        self.bytes_in += len(line)
+        line = line.rstrip(b'\r\n')
+        literal = self.literal_re.search(line)
+        while literal:
+            data = await self._readexactly(int(literal[1]))
+            parts.append((line, data))
+            line = await self._readline()
+            self.bytes_in += len(data) + len(line)
+            line = line.rstrip(b'\r\n')
+            literal = self.literal_re.search(line)
+        parts.append(line)
+        return parts
+
+    def _untagged(self, parts: list[bytes | tuple[bytes, bytes]]) -> None:
+        # "* 12 FETCH (...)" is handed as b"12 (...)" like imaplib does
+        data = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+        data = data[2:]
+        number, _, rest = data.partition(b' ')
+        if number.isdigit() and rest.startswith(b'FETCH '):
+            data = number + b' ' + rest[6:]
+        parts[0] = (data, parts[0][1]) if isinstance(parts[0], tuple) else data
+        if not self.pending:
+            return
+        command = self.pending[0]
+        if not command.callback:
+            command.untagged.append(parts)
+            return
+        try:
+            command.callback(parts)
+        except Exception as e:
+            command.error = e
+
+    def _tagged(self, line: bytes) -> None:
+        tag, _, rest = str(line, 'utf-8', 'replace').partition(' ')
+        for command in self.pending:
+            if command.tag == tag:
+                break
+        else:
+            return
+        self.pending.remove(command)
+        capabilities = response_capabilities(rest)
+        if capabilities is not None:
+            self.capabilities = capabilities
+        imap_stats.record_command(
+            command.name, time.perf_counter() - command.start,
+            command.bytes_in, command.bytes_out)
+        if self.compressor:
+            imap_stats.record_compression(
+                command.bytes_in, command.wire_bytes_in,
+                command.bytes_out, command.wire_bytes_out)
+        elif command.name == 'COMPRESS' and rest.startswith('OK '):
+            # Before reading the next response, which is compressed
+            self.compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        if command.error:
+            command.future.set_exception(command.error)
+        else:
+            command.future.set_result(
+                (rest.partition(' ')[0], command.untagged))
+
+    async def _read_responses(self) -> None:
+        try:
+            while True:
+                bytes_in, wire_bytes_in = self.bytes_in, self.wire_bytes_in
+                parts = await self._read_response()
+                # Responses are accounted to the oldest pending command
+                if self.pending:
+                    self.pending[0].bytes_in += self.bytes_in - bytes_in
+                    self.pending[0].wire_bytes_in += \
+                        self.wire_bytes_in - wire_bytes_in
+                head = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+                if head.startswith(b'* '):
+                    self._untagged(parts)
+                elif not head.startswith(b'+'):
+                    self._tagged(head)
+        except Exception as e:
+            self.closed = True
+            for command in self.pending:
+                if not command.future.done():
+                    command.future.set_exception(e)
+            self.pending.clear()
+
+    def send(
+        self,
+        command: str,
+        callback: Callable[[list[bytes | tuple[bytes, bytes]]], None] = None,
+            ) -> asyncio.Future:
+        # Callback, if any, gets the untagged responses as they arrive
+        # instead of them being returned with the command status
+        self.tag_number += 1
+        pending_command = AsyncImapCommand(f"A{self.tag_number:05d}", callback)
+        words = command.split(' ', 2)
+        pending_command.name = ' '.join(words[:2]) if words[0] == 'UID' \
+            else words[0]
+        data = f"{pending_command.tag} {command}\r\n".encode()
+        pending_command.bytes_out = len(data)
+        if self.compressor:
+            data = self.compressor.compress(data) + \
+                self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        pending_command.wire_bytes_out = len(data)
+        if self.closed:
+            # The reader task is over, nothing would complete the command
+            pending_command.future.set_exception(
+                ConnectionError("IMAP connection closed"))
+            return pending_command.future
+        self.pending.append(pending_command)
+        self.writer.write(data)
+        return pending_command.future
+
+    async def login(
+        self,
+        user: str,
+        password: str,
+            ) -> None:
+        result, untagged = await self.send(
+            f"LOGIN {imap_quote(user)} {imap_quote(password)}")
+        if result != 'OK':
+            raise imaplib.IMAP4.error(f"IMAP Login error: {result}")
+        if imap_compress:
+            # Same as CompressedImap, mostly advertised once authenticated
+            # (LOGIN completion code or untagged CAPABILITY)
+            capabilities = self.capabilities or response_capabilities(
+                '', [parts[0][11:] for parts in untagged
+                     if parts[0].upper().startswith(b'CAPABILITY ')])
+            if capabilities is None:
+                result, untagged = await self.send("CAPABILITY")
+                capabilities = response_capabilities(
+                    '', [parts[0][11:] for parts in untagged
+                         if parts[0].upper().startswith(b'CAPABILITY ')])
+            if 'COMPRESS=DEFLATE' in (capabilities or ()):
+                result, _ = await self.send("COMPRESS DEFLATE")
+                if result != 'OK':
+                    print(f"WARNING: COMPRESS DEFLATE returned {result}")
+
+    async def logout(self) -> None:
+        try:
+            await self.send("LOGOUT")
+        except Exception:
+            pass
+        self.reader_task.cancel()
+        self.writer.close()
+
+
+async def async_folder_size(
+    conn: AsyncImapConnection,
+    folder_entry: bytes,
+    returned_folder_attributes: dict[str, str | int],
+    progress: FolderProgress = None,
+    messages: dict[int, tuple[int, tuple[int, int], tuple[str, ...]]] = None,
+        ) -> Exception | None:
+    mailbox = folder_mailbox(folder_entry)
+    if isinstance(mailbox, Exception):
+        return mailbox
+    mbx, rmbx = mailbox
+    # Messages (size, date, flags) indexed by UID, the ones fetched before
+    # the connection was lost being kept when resuming the folder scan
+    if messages is None:
+        messages = {}
+    uidset = f"{max(messages) + 1}:*" if messages else "1:*"
+    batch = []
+
+    def fetched(parts: list[bytes | tuple[bytes, bytes]]) -> None:
+        # Parsed as soon as received, dates being decoded by batches
+        with imap_stats.timed('parse', mbx):
+            count = len(batch)
+            batch.extend(parse_fetch_responses(parts))
+            conn.fetched_messages += len(batch) - count
+            if len(batch) < fetch_batch_size:
+                return
+            store_fetched_messages(batch, messages)
+            batch.clear()
+        # Once per batch, outside of the parse time
+        if progress:
+            progress.update_task(completed=len(messages))
+
+    # The FETCH is sent right after the EXAMINE, without waiting for it
+    examined = conn.send(f"EXAMINE {mbx}")
+    fetch = conn.send(f"UID FETCH {uidset} {messages_fetch_items()}", fetched)
+    try:
+        try:
+            result, untagged = await examined
+        finally:
+            fetch_result, _ = await fetch
+    finally:
+        with imap_stats.timed('parse', mbx):
+            store_fetched_messages(batch, messages)
+    if result != 'OK':
+        return Exception(f"{mbx} IMAP folder select returned {result} " +
+                         "(async_folder_size)")
+    nmessages = 0
+    uidvalidity = None
+    for parts in untagged:
+        number, _, response = parts[-1].partition(b' ')
+        if response == b'EXISTS':
+            nmessages = int(number)
+        elif parts[-1].startswith(b'OK [UIDVALIDITY '):
+            uidvalidity = int(parts[-1][16:].partition(b']')[0])
+    if progress and nmessages > 0:
+        progress.update_task(
+            description="[cyan]Scanning %s (%d)..." % (rmbx, nmessages),
+            total=nmessages,
+            completed=len(messages),
+            visible=True,
+            )
+    # Empty folders can legitimately fail the 1:* FETCH
+    if fetch_result != 'OK' and nmessages > 0:
+        return Exception(f"{mbx} IMAP messages fetch returned " +
+                         f"{fetch_result} (async_folder_size)")
+    with imap_stats.timed('parse', mbx):
+        folder_messages_attributes(
+            mbx, rmbx, nmessages, messages, returned_folder_attributes)
+    returned_folder_attributes['uidvalidity'] = uidvalidity
+    return None
+
+
+async def async_scan_folders(
+    folders: list[bytes],
+    connections: int,
+    user: str,
+    password: str,
+    progress: Progress = None,
+    export: MessagesCsvExport = None,
+        ) -> list[tuple[dict[str, str | int], Exception | None]]:
+    # All connections share the same event loop, each one keeping up to
+    # pipeline_depth folders scans in flight
+    scanned_folders = [
+        ({}, Exception(f"{folder} IMAP folder not scanned " +
+                       "(async_scan_folders)"))
+        for folder in folders]
+    # Index, folder, messages already fetched, connections lost
+    pending_folders = collections.deque(
+        (index, folder, {}, 0) for index, folder in enumerate(folders))
+    if progress:
+        main_folder_task = progress.add_task(
+            f"[yellow]Processing folders ({connections} connections)...",
+            total=len(folders))
+
+    async def scan_folder(
+        conn: AsyncImapConnection,
+        index: int,
+        folder: bytes,
+        messages: dict[int, tuple[int, tuple[int, int], tuple[str, ...]]],
+        attempt: int,
+        worker_progress: FolderProgress,
+            ) -> None:
+        folder_infos = dict()
+        fetched = len(messages)
+        try:
+            ex = await async_folder_size(
+                conn, folder, folder_infos, worker_progress, messages)
+        except Exception as e:
+            ex = e
+        if ex and conn.closed:
+            # Only the attempts without any progress count: neither this
+            # folder nor the ones ahead of it in the pipeline (which it
+            # waited for) fetched anything before the connection was lost
+            if len(messages) > fetched or conn.fetched_messages:
+                attempt = 0
+            if attempt < reconnect_attempts:
+                # Resumed on a new connection
+                pending_folders.appendleft(
+                    (index, folder, messages, attempt + 1))
+                return
+        if export:
+            export.write_folder(folder_infos)
+        scanned_folders[index] = (folder_infos, ex)
+        if progress:
+            progress.update(main_folder_task, advance=1)
+
+    async def connect(worker_id: int) -> AsyncImapConnection | None:
+        for attempt in range(reconnect_attempts + 1):
+            if attempt:
+                await asyncio.sleep(min(2 ** (attempt - 1), 60))
+            try:
+                conn = await AsyncImapConnection.open(imap_server, imap_port)
+                await conn.login(user, password)
+                return conn
+            except imaplib.IMAP4.error as e:
+                # Authentication refused, no need to retry
+                print(f"Connection {worker_id} got {e} (async_scan_folders)")
+                return None
+            except Exception as e:
+                print(f"Connection {worker_id} got {e} (async_scan_folders)")
+        return None
+
+    async def worker(worker_id: int) -> None:
+        worker_progress = None
+        if progress:
+            worker_progress = FolderProgress(progress)
+            worker_progress.set_task(progress.add_task(
+                f"[cyan]\tConnection {worker_id} idle...",
+                visible=False,
+            ))
+        conn = await connect(worker_id)
+        if not conn:
+            return
+        in_flight = set()
+        while True:
+            # Folders in flight may come back to pending_folders when the
+            # connection is lost
+            if in_flight and (len(in_flight) >= pipeline_depth or
+                              conn.closed or not pending_folders):
+                _, in_flight = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            if conn.closed:
+                print(f"WARNING: connection {worker_id} lost, reconnecting")
+                conn = await connect(worker_id)
+                if not conn:
+                    return
+            if not pending_folders:
+                break
+            index, folder, messages, attempt = pending_folders.popleft()
+            in_flight.add(asyncio.create_task(scan_folder(
+                conn, index, folder, messages, attempt, worker_progress)))
+        await conn.logout()
+
+    await asyncio.gather(*(
+        worker(worker_id) for worker_id in range(connections)))
+    return scanned_folders
+
+
+def scan_account_folders(
+    cnx: imaplib.IMAP4_SSL,
+    folders: list[bytes],
+    user: str,
+    password: str,
+    progress: Progress = None,
+    folders_state: dict = None,
+    export: MessagesCsvExport = None,
+        ) -> list[tuple[dict, Exception]]:
+    # Scan with the engine selected by the configuration, local sources
+    # being read sequentially
+    if isinstance(cnx, LocalMailSource):
+        return scan_folders(cnx, folders, progress, None, export)
+    if imap_async:
+        return asyncio.run(async_scan_folders(
+            folders, imap_workers, user, password, progress, export))
+    if imap_workers > 1:
+        return scan_folders_parallel(
+            cnx, folders, imap_workers, user, password, progress,
+            folders_state, export)
+    return scan_folders(cnx, folders, progress, folders_state, export)
 
 
 def get_progress_context() -> Progress | contextlib.nullcontext:
-    if os.getenv("NO_PROGRESS"):
+    # Batch processes write their reports to files
+    if os.getenv("NO_PROGRESS") or batch_accounts:
         return contextlib.nullcontext()
     return Progress(transient=True, expand=True)
 
 
-# Press the green button in the gutter to run the script.
-if __name__ == '__main__':
+def report_imap_stats(
+    usr: str,
+    file_desc: str,
+        ) -> None:
+    if not imap_stats_output:
+        return
+    print("\n", tabulate.tabulate(
+        imap_stats.commands_rows(),
+        headers=["Command", "# Cmd", "Time", "Mean ms", "Max ms",
+                 "Received", "Sent"],
+        floatfmt=".2f"))
+    print("\n", tabulate.tabulate(
+        imap_stats.phases_rows(),
+        headers=["Phase", "Time", "Slowest folder", "Folder time"],
+        floatfmt=".2f"))
+    if imap_stats_output.endswith(('.json', '.prom')):
+        path = imap_stats_output
+        # One file per account in batch mode
+        if batch_accounts:
+            root, ext = os.path.splitext(path)
+            path = f"{root}-{file_desc}{ext}"
+        imap_stats.write(path, {'account': usr, 'server': imap_server})
+
+
+def report_gmail_labels(
+    scanned_folders: list[tuple[dict, Exception]],
+    labels_names: dict[str, str],
+    gmail_messages: list[tuple[np.ndarray, np.ndarray]],
+    quota_used: int | None,
+    file_desc: str,
+        ) -> None:
+    # Per-label view of the Gmail mode, a message being counted in each of
+    # its labels, next to the deduplicated usage (messages ids found in
+    # several scanned folders counted once)
+    labels = {}
+    for folder_infos, _ in scanned_folders:
+        for label, (count, unread, size) in folder_infos.get(
+                'labels', {}).items():
+            # Trash and Spam messages without labels only have their folder
+            if not label and folder_infos['name'] != labels_names.get(''):
+                label = parse_imap_astring(
+                    folder_infos['mailbox'].encode())[0]
+            label_usage = labels.setdefault(label, [0, 0, 0])
+            label_usage[0] += count
+            label_usage[1] += unread
+            label_usage[2] += size
+    rows = []
+    for label, (count, unread, size) in sorted(
+            labels.items(), key=lambda item: -item[1][2]):
+        row = [labels_names.get(label) or folder_real_name(label)
+               if label else "(no label)", count, unread, size]
+        if quota_used:
+            row.append((100.0 * size) / (1024 * quota_used))
+        rows.append(row)
+    hfields = ["Label", "# Msg", "# Unread", "Size"]
+    if quota_used:
+        hfields.append("Quota%")
+    print("\n", tabulate.tabulate(rows, headers=hfields, floatfmt=".2f"))
+    with open(
+            f'labels-{file_desc}.csv',
+            "w",
+            encoding='utf-8'
+            ) as f:
+        writer = csv.writer(f)
+        writer.writerow(hfields)
+        writer.writerows(rows)
+    # Folders with messages but without their labels (scan errors)
+    unlabelled = [
+        folder_infos['name'] for folder_infos, _ in scanned_folders
+        if folder_infos.get('messages') and 'labels' not in folder_infos]
+    if unlabelled:
+        print("WARNING: labels and messages ids unknown in " +
+              ", ".join(unlabelled) + ", left out of the labels view and " +
+              "of the deduplicated usage")
+    if not gmail_messages:
+        print("\nDeduplicated usage unknown: no Gmail messages ids fetched")
+        return
+    msgids = np.concatenate([msgids for msgids, _ in gmail_messages])
+    sizes = np.concatenate([sizes for _, sizes in gmail_messages])
+    _, first_indexes = np.unique(msgids, return_index=True)
+    print(f"\nDeduplicated usage: {len(first_indexes)} messages, " +
+          f"{human_readable_size(int(sizes[first_indexes].sum()))} " +
+          f"(labels view: {sum(row[1] for row in rows)} messages, " +
+          f"{human_readable_size(sum(row[3] for row in rows))})")
+
+
+def account_report(
+    usr: str,
+    passwd: str,
+    file_desc: str,
+        ) -> dict[str, int | None] | Exception:
+    # Scan and report of one account, its CSV files being named after
+    # file_desc. Returns the account totals or the connection error
     try:
-        # User is retrieved from LOGNAME environment variable
-        # password is asked on command line or environment variable
-        (usr, passwd) = (getpass.getuser(), env_or_tty_passwd())
-        cnx = login(imap_server, user=usr, password=passwd)
-        quota_used, quota_total = get_quotas(cnx)
-        folders = get_folders(cnx)
-    except imaplib.IMAP4.error as e:
-        print(f"IMAP error: {e}")
-        sys.exit(1)
+        if local_source:
+            cnx = LocalMailSource(local_source)
+            quota_used, quota_total = cnx.quotas()
+        else:
+            cnx = login(imap_server, imap_port, usr, passwd)
+            quota_used, quota_total = get_quotas(cnx)
+        folders_state = None
+        if imap_overview:
+            scanned_folders = folders_overview(cnx)
+        elif local_source:
+            folders = cnx.list_folders()
+        else:
+            folders = get_folders(cnx)
+        if gmail_mode:
+            if 'X-GM-EXT-1' not in cnx.capabilities:
+                raise Exception("IMAP_GMAIL: no X-GM-EXT-1 capability")
+            labels_names = gmail_labels_names(folders)
+            folders = gmail_folders(folders)
+        # The asyncio engine, local sources, the Gmail mode (labels not
+        # kept in the state) and the senders group-by always do full scans
+        if folders_state_dir and not imap_async and not imap_overview and \
+                not local_source and not gmail_mode and not group_by_senders:
+            folders_state = load_folders_state(
+                folders_state_path(usr, imap_server))
+        # Messages CSV written as folders are scanned, folders already
+        # exported by an interrupted run are not scanned again
+        exported_folders = {}
+        if not imap_overview:
+            export = MessagesCsvExport(
+                imap_resume or f'messages-{file_desc}.csv',
+                resume=bool(imap_resume))
+            exported_folders = export.exported_folders()
     except Exception as e:
-        print(f"Exception error: {e}")
-        sys.exit(2)
+        return e
 
     nmessages_total = 0
     nunread_total = 0
     size_total = 0
 
     imap_folders = []
-    messages_infos = []
-    sub_progress = None
-    # Progress bar which will disapear once all folders processed
-    with get_progress_context() as progress:
-        if progress:
-            main_folder_task = progress.add_task(
-                "[yellow]Processing folders...",
-                total=len(folders))
-            sub_progress = FolderProgress(progress)
-            sub_folder_task = progress.add_task(
-                "[cyan]\tScanning XXX...",
-                visible=False,
-            )
-            sub_progress.set_task(sub_folder_task)
-        for folder in folders:
-            if progress:
-                progress.update(main_folder_task, advance=1)
-            folder_infos = dict()
-            ex = folder_size(cnx, folder, folder_infos, sub_progress)
-            if ex:
-                print(f'{error_or_warning(len(folder_infos) > 0)}: got {ex}')
-            if folder_infos.get('name'):
-                folder_stats = [
-                    folder_infos['name'],
-                    folder_infos['messages'],
-                    folder_infos['unread'],
-                    folder_infos['size'],
-                    ]
-                if quota_used:
-                    folder_stats.append(
-                        (100.0 * folder_infos['size'])
-                        / (1024 * quota_used))
-                imap_folders.append(folder_stats)
-                nmessages_total += folder_infos['messages']
-                size_total += folder_infos['size']
-                nunread_total += folder_infos['unread']
-                messages_infos.extend(folder_infos.get('infos', []))
+    messages_summary = MessagesSummary()
+    biggest_messages = BiggestMessages(biggest_count)
+    # Group-by reports need all the messages
+    messages_infos = MessagesStore() if group_by_reports else None
+    # Gmail messages ids and sizes of the scanned folders
+    gmail_messages = []
+    # Folders infos already retrieved from their STATUS in overview mode
+    if not imap_overview:
+        # Progress bar which will disapear once all folders processed
+        folders_mailboxes = [
+            None if isinstance(mailbox, Exception) else mailbox[0]
+            for mailbox in map(folder_mailbox, folders)]
+        pending_folders = [
+            folder for folder, mbx in zip(folders, folders_mailboxes)
+            if mbx not in exported_folders]
+        # The asyncio engine uses its own connections
+        with get_progress_context() as progress, \
+                cnx.keepalive() if imap_async else contextlib.nullcontext():
+            pending_scanned_folders = iter(scan_account_folders(
+                cnx, pending_folders, usr, passwd, progress, folders_state,
+                export))
+        export.close()
+        scanned_folders = []
+        for mbx in folders_mailboxes:
+            if mbx in exported_folders:
+                folder_infos = exported_folders[mbx]
+                # Still valid for next incremental scan
+                if folders_state and mbx in folders_state:
+                    folder_infos['state'] = folders_state[mbx]
+                scanned_folders.append((folder_infos, None))
+            else:
+                scanned_folders.append(next(pending_scanned_folders))
+    if folders_state is not None:
+        save_folders_state(
+            folders_state_path(usr, imap_server),
+            [folder_infos['state']
+             for folder_infos, _ in scanned_folders
+             if 'state' in folder_infos])
+    # Folders snapshots and messages need a scan
+    if messages_index_path and not imap_overview:
+        try:
+            with contextlib.closing(
+                    open_messages_index(messages_index_path)) as db, \
+                    cnx.keepalive():
+                update_messages_index(
+                    db, f"{usr}@{imap_server}", folders, scanned_folders)
+        except sqlite3.Error as e:
+            print(f"WARNING: index {messages_index_path} not updated: {e}")
+    for folder_infos, ex in scanned_folders:
+        if ex:
+            print(f'{error_or_warning(len(folder_infos) > 0)}: got {ex}')
+        if folder_infos.get('name'):
+            folder_stats = [
+                folder_infos['name'],
+                folder_infos['messages'],
+                folder_infos['unread'],
+                folder_infos['size'],
+                ]
+            if quota_used and folder_infos['size'] is not None:
+                folder_stats.append(
+                    (100.0 * folder_infos['size'])
+                    / (1024 * quota_used))
+            imap_folders.append(folder_stats)
+            nmessages_total += folder_infos['messages']
+            size_total += folder_infos['size'] or 0
+            nunread_total += folder_infos['unread']
+            if 'summary' in folder_infos:
+                messages_summary.merge(folder_infos['summary'])
+            if 'biggest' in folder_infos:
+                biggest_messages.merge(folder_infos['biggest'])
+            if messages_infos is not None and 'infos' in folder_infos:
+                messages_infos.extend(folder_infos['infos'])
+            if 'gm_msgids' in folder_infos:
+                gmail_messages.append(
+                    (folder_infos['gm_msgids'], folder_infos['infos'].sizes))
+            # Exported and indexed, only the summaries are needed now
+            folder_infos.pop('infos', None)
+    invalid_dates = {
+        folder_infos['name']: folder_infos['invalid_dates']
+        for folder_infos, _ in scanned_folders
+        if folder_infos.get('invalid_dates')}
+    # Dates are not fetched at all with IMAP_NO_DATES
+    dates_reported = fetch_dates or local_source
+    if invalid_dates and dates_reported:
+        print(f"WARNING: {sum(invalid_dates.values())} messages without " +
+              "a valid INTERNALDATE in " + ", ".join(
+                  f"{name} ({count})" for name, count in invalid_dates.items()))
     summary = ["Sum", nmessages_total, nunread_total, size_total]
     hfields = ["Folder", "# Msg", "# Unread", "Size"]
     if quota_used:
@@ -474,7 +3687,6 @@ if __name__ == '__main__':
     # summmary row
     data = [hfields]
     data.extend(imap_folders[:-1])
-    file_desc = datetime.now().strftime("%Y-%m-%d-%H-%M")
     with open(
             f'folders-{file_desc}.csv',
             "w",
@@ -482,16 +3694,6 @@ if __name__ == '__main__':
             ) as f:
         writer = csv.writer(f)
         writer.writerows(data)
-    with open(
-            f'messages-{file_desc}.csv',
-            "w",
-            encoding='utf-8'
-            ) as f:
-        writer = csv.writer(f, delimiter='|')
-        # Header
-        writer.writerow(list(messages_infos[0].keys()))
-        for msg in messages_infos:
-            writer.writerow(convert_message_entry(list(msg.values())))
     if quota_used and quota_total:
         print(f"\nQuotas Used: {human_readable_size(quota_used*1024)} " +
               f"Total: {human_readable_size(quota_total*1024)} " +
@@ -501,38 +3703,108 @@ if __name__ == '__main__':
                   f"{human_readable_size(size_total)} Used%: " +
                   f"{(100*size_total)/(1024*quota_used):.2f}% " +
                   f"Total%: {(100*size_total)/(1024*quota_total):.2f}%")
-    sdata = np.array(list(map(lambda x: x.get("size"), messages_infos)))
-    ddata = np.array(list(map(lambda x: x.get("date"), messages_infos)))
-    print(f"\nMessage sizes: [{sdata.min()} - {sdata.max()}]")
-    print(f"\nMessage dates: [{ddata.min()} - {ddata.max()}]")
-    over95percent = int(sdata.mean() + 2 * sdata.std())
-    print(f"\nMessages over {human_readable_size(over95percent)} " +
-          "(upper 95% quartile):\n")
+    savings = imap_stats.savings_rows()
+    if savings:
+        print("\n", tabulate.tabulate(
+            savings, headers=["Transfer", "Bytes", "On the wire", "Saved",
+                              "Saved%"]))
+    if gmail_mode:
+        report_gmail_labels(
+            scanned_folders, labels_names, gmail_messages, quota_used,
+            file_desc)
+    account_totals = {
+        'messages': nmessages_total,
+        'unread': nunread_total,
+        'size': size_total,
+        'quota_used': quota_used * 1024 if quota_used else None,
+        'quota_total': quota_total * 1024 if quota_total else None,
+        'biggest': 0,
+        'to_save': 0,
+        }
+    if imap_overview or messages_summary.count == 0:
+        cnx.logout()
+        report_imap_stats(usr, file_desc)
+        return account_totals
+    ddata = messages_summary.dates_range()
+    print(f"\nMessage sizes: [{messages_summary.min_size} - " +
+          f"{messages_summary.max_size}] percentiles: " + ", ".join(
+              f"p{percentile} " + human_readable_size(
+                  messages_summary.quantile(percentile / 100))
+              for percentile in (50, 95, 99)))
+    if dates_reported:
+        print(f"\nMessage dates: [{ddata[0]} - {ddata[1]}]")
+    # Sizes and dates distributions, monthly one in CSV only
+    histograms = [
+        ("Size", messages_summary.sizes_rows(),
+         "sizes", "Size", messages_summary.sizes_rows())]
+    if dates_reported:
+        histograms.append(
+            ("Year", messages_summary.months_rows(12),
+             "months", "Month", messages_summary.months_rows()))
+    for title, rows, csv_name, csv_title, csv_rows in histograms:
+        hfields = [title, "# Msg", "Msg%", "Total size", "Size%"]
+        print("\n", tabulate.tabulate(rows, headers=hfields, floatfmt=".2f"))
+        with open(
+                f'{csv_name}-histogram-{file_desc}.csv',
+                "w",
+                encoding='utf-8'
+                ) as f:
+            writer = csv.writer(f)
+            writer.writerow([csv_title] + hfields[1:])
+            writer.writerows(csv_rows)
+    for keys in group_by_reports:
+        with imap_stats.timed('group-by'):
+            columns = group_messages(messages_infos, keys)
+        hfields = [key.capitalize() for key in keys] + [
+            "# Msg", "# Unread", "Total size", "Unread size", "Size%"]
+        ngroups = len(columns[0])
+        print(f"\nBy {', '.join(keys)} ({ngroups} groups, " +
+              f"{min(ngroups, group_by_rows)} biggest):\n")
+        print(tabulate.tabulate(
+            zip(*(column[:group_by_rows] for column in columns)),
+            headers=hfields, floatfmt=".2f"))
+        with open(
+                f'group-by-{"-".join(keys)}-{file_desc}.csv',
+                "w",
+                encoding='utf-8'
+                ) as f:
+            writer = csv.writer(f, delimiter='|')
+            writer.writerow(hfields)
+            writer.writerows(zip(*columns))
+    if biggest_percentile:
+        over_percentile = messages_summary.quantile(biggest_percentile / 100)
+        print(f"\nMessages over {human_readable_size(over_percentile)} " +
+              f"({biggest_percentile:g}th percentile, at most " +
+              f"{biggest_count}):\n")
+    else:
+        over_percentile = 0
+        print(f"\n{biggest_count} biggest messages:\n")
     to_save = 0
-    big_messages = sorted(
-        list(
-            filter(
-                lambda x: x.get("size", 0) > over95percent,
-                messages_infos)
-            ),
-        key=lambda x: x.get("size"))
+    big_messages = biggest_messages.messages(over_percentile)
     biggest = []
+    # Headers captured by the detailed scan are only decoded now, the
+    # other ones (or all without IMAP_DETAILS) being fetched
+    big_messages_headers = {
+        (msg['folder'], msg['id']): decode_subject_from_to(
+            msg['folder'], msg['id'], msg['headers'])
+        for msg in big_messages if msg.get('headers')}
     with get_progress_context() as progress:
-        if progress:
-            main_folder_task = progress.add_task(
-                "[yellow]Processing biggest messages...",
-                total=len(big_messages))
+        big_messages_headers.update(messages_subject_from_to(
+            cnx, [msg for msg in big_messages if not msg.get('headers')],
+            progress))
         for msg in big_messages:
-            if progress:
-                progress.update(main_folder_task, advance=1)
-            msg_from, msg_to, msg_subject = message_subject_from_to(cnx, msg)
+            if (msg.get("folder"), msg.get("id")) not in big_messages_headers:
+                print("Unable to retrieve headers for message " +
+                      f"{msg.get('id')} in {msg.get('folder')}")
+            msg_from, msg_to, msg_subject = big_messages_headers.get(
+                (msg.get("folder"), msg.get("id")),
+                ("(None)", "(None)", "(None)"))
             biggest.append([
                 msg.get("id"),
                 human_readable_size(msg.get("size")),
                 (100.0 * msg.get("size")) / (1024 * quota_used),
                 msg.get("date"),
-                folder_real_name(
-                    msg.get("folder").strip('"')),
+                mailbox_real_name(msg.get("folder")),
                 msg_from,
                 msg_subject])
             to_save += msg.get("size")
@@ -559,3 +3831,205 @@ if __name__ == '__main__':
           "messages number)\n")
     # Close the connection
     cnx.logout()
+    report_imap_stats(usr, file_desc)
+    account_totals.update(biggest=len(big_messages), to_save=to_save)
+    return account_totals
+
+
+def read_accounts(
+    path: str,
+        ) -> list[tuple[str, str, str]]:
+    # One login|password|server line per account, the server defaulting to
+    # IMAP_SERVER. Empty lines and lines starting with # are ignored
+    accounts = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f, delimiter='|'):
+            if not row or not row[0].strip() or row[0].startswith('#'):
+                continue
+            if len(row) < 2:
+                raise ValueError(f"{path}: no password for {row[0]}")
+            accounts.append((
+                row[0].strip(), row[1],
+                row[2].strip() if len(row) > 2 and row[2].strip()
+                else imap_server))
+    return accounts
+
+
+def batch_account_report(
+    usr: str,
+    passwd: str,
+    server: str,
+    file_desc: str,
+        ) -> dict[str, str | int | None]:
+    # Process pool task: the account report goes to its own text file,
+    # failures being returned instead of stopping the batch
+    global imap_server, imap_resume, imap_stats
+    imap_server = server
+    imap_stats = ImapStats()
+    # Each account has its own messages CSV
+    imap_resume = None
+    account_totals = {'account': usr, 'server': server}
+    try:
+        with open(f'report-{file_desc}.txt', 'w', encoding='utf-8') as f, \
+                contextlib.redirect_stdout(f):
+            result = account_report(usr, passwd, file_desc)
+    except Exception as e:
+        result = e
+    if isinstance(result, Exception):
+        account_totals['error'] = str(result) or type(result).__name__
+    else:
+        account_totals.update(result)
+    return account_totals
+
+
+def batch_scan(
+    accounts: list[tuple[str, str, str]],
+    file_desc: str,
+        ) -> list[dict[str, str | int | None]]:
+    # Accounts scanned by batch_processes processes, an account being only
+    # started when its server has enough connections left (an account
+    # needing more than server_connections runs alone on its server).
+    # Results are kept in the accounts file order
+    connections = imap_workers + (1 if imap_async else 0)
+    results = [None] * len(accounts)
+    pending_accounts = list(range(len(accounts)))
+    server_connections_used = collections.Counter()
+    running = {}
+    with ProcessPoolExecutor(max_workers=batch_processes) as executor:
+        while pending_accounts or running:
+            for index in list(pending_accounts):
+                if len(running) >= batch_processes:
+                    break
+                usr, passwd, server = accounts[index]
+                used = server_connections_used[server]
+                if used and used + connections > server_connections:
+                    continue
+                pending_accounts.remove(index)
+                server_connections_used[server] += connections
+                running[executor.submit(
+                    batch_account_report, usr, passwd, server,
+                    re.sub(r'[^\w.@+-]', '_', f"{usr}@{server}") +
+                    f"-{file_desc}")] = index
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                usr, _, server = accounts[index]
+                server_connections_used[server] -= connections
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    # Worker process killed
+                    results[index] = {
+                        'account': usr, 'server': server,
+                        'error': str(e) or type(e).__name__}
+    return results
+
+
+# Press the green button in the gutter to run the script.
+if __name__ == '__main__':
+    if gmail_mode and imap_overview:
+        print("IMAP_GMAIL can not be used with IMAP_OVERVIEW")
+        sys.exit(1)
+    if local_source:
+        if imap_overview or batch_accounts or gmail_mode:
+            print("IMAP_LOCAL can not be used with IMAP_OVERVIEW, " +
+                  "IMAP_ACCOUNTS or IMAP_GMAIL")
+            sys.exit(1)
+        # The archive path stands for the server in the index
+        imap_server = os.path.abspath(local_source)
+    if index_report:
+        # Only the local index is queried, no IMAP connection
+        if not messages_index_path or not os.path.exists(messages_index_path):
+            print("IMAP_INDEX_REPORT needs an existing IMAP_INDEX")
+            sys.exit(1)
+        try:
+            with contextlib.closing(
+                    open_messages_index(messages_index_path)) as db:
+                hfields, rows = messages_index_report(
+                    db, f"{getpass.getuser()}@{imap_server}", index_report)
+        except (sqlite3.Error, ValueError) as e:
+            print(f"Index error: {e}")
+            sys.exit(2)
+        print("\n", tabulate.tabulate(rows, headers=hfields, floatfmt=".2f"))
+        sys.exit(0)
+    date_keys = [
+        key for keys in group_by_reports for key in keys
+        if key in ('year', 'month', 'age')]
+    if date_keys and not fetch_dates and not local_source:
+        print(f"IMAP_GROUP_BY keys {', '.join(date_keys)} can not be used " +
+              "with IMAP_NO_DATES")
+        sys.exit(1)
+    unknown_keys = [
+        key for keys in group_by_reports for key in keys
+        if key not in group_by_keys]
+    if unknown_keys:
+        print(f"Unknown IMAP_GROUP_BY keys {', '.join(unknown_keys)}, " +
+              f"expecting {', '.join(group_by_keys)}")
+        sys.exit(1)
+    if group_by_senders and not detailed_infos:
+        print("IMAP_GROUP_BY keys sender and domain need IMAP_DETAILS")
+        sys.exit(1)
+    if group_by_senders and imap_resume:
+        print(f"WARNING: IMAP_RESUME {imap_resume} ignored, the senders of " +
+              "the exported messages are unknown: full scan exported to a " +
+              "new messages CSV")
+        imap_resume = None
+    if gmail_mode and imap_resume:
+        print(f"WARNING: IMAP_RESUME {imap_resume} ignored, the labels of " +
+              "the exported messages are unknown: full scan exported to a " +
+              "new messages CSV")
+        imap_resume = None
+    file_desc = datetime.now().strftime("%Y-%m-%d-%H-%M")
+    if batch_accounts:
+        try:
+            accounts = read_accounts(batch_accounts)
+        except (OSError, ValueError) as e:
+            print(f"Accounts error: {e}")
+            sys.exit(1)
+        accounts_totals = batch_scan(accounts, file_desc)
+        hfields = ["Account", "Server", "# Msg", "# Unread", "Size",
+                   "Quota%", "# Biggest", "Biggest size", "Error"]
+        rows = [
+            [account_totals['account'],
+             account_totals['server'],
+             account_totals.get('messages'),
+             account_totals.get('unread'),
+             account_totals.get('size'),
+             (100.0 * account_totals['quota_used']) /
+             account_totals['quota_total']
+             if account_totals.get('quota_total') else None,
+             account_totals.get('biggest'),
+             account_totals.get('to_save'),
+             account_totals.get('error', '')]
+            for account_totals in accounts_totals]
+        with open(
+                f'accounts-{file_desc}.csv',
+                "w",
+                encoding='utf-8'
+                ) as f:
+            writer = csv.writer(f, delimiter='|')
+            writer.writerow(hfields)
+            writer.writerows(rows)
+        failed = sum(1 for account_totals in accounts_totals
+                     if 'error' in account_totals)
+        rows.append(["Sum", "",
+                     sum(row[2] or 0 for row in rows),
+                     sum(row[3] or 0 for row in rows),
+                     sum(row[4] or 0 for row in rows),
+                     None,
+                     sum(row[6] or 0 for row in rows),
+                     sum(row[7] or 0 for row in rows),
+                     f"{failed} failed" if failed else ""])
+        print("\n", tabulate.tabulate(rows, headers=hfields, floatfmt=".2f"))
+        sys.exit(1 if failed else 0)
+    # User is retrieved from LOGNAME environment variable
+    # password is asked on command line or environment variable
+    (usr, passwd) = (
+        getpass.getuser(), '' if local_source else env_or_tty_passwd())
+    result = account_report(usr, passwd, file_desc)
+    if isinstance(result, imaplib.IMAP4.error):
+        print(f"IMAP error: {result}")
+        sys.exit(1)
+    if isinstance(result, Exception):
+        print(f"Exception error: {result}")
+        sys.exit(2)